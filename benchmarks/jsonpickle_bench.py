@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright (C) 2014  Lionel Bergeret
+#
+# ----------------------------------------------------------------
+# The contents of this file are distributed under the CC0 license.
+# See http://creativecommons.org/publicdomain/zero/1.0/
+# ----------------------------------------------------------------
+from __future__ import print_function
+
+import os
+import sys
+import time
+import random
+from datetime import datetime
+from optparse import OptionParser
+
+#
+# jsonpickle benchmarks
+#
+# Each case prints the best time of several runs, the machine noise only
+# making runs slower. Compare two versions with -p, e.g. against a checkout
+# of an earlier commit:
+#
+#   git worktree add /tmp/before <commit>
+#   python benchmarks/jsonpickle_bench.py -p /tmp/before
+#   python benchmarks/jsonpickle_bench.py
+#
+
+def best(function, runs):
+    times = []
+    for i in range(runs):
+        start_time = time.time()
+        function()
+        times.append(time.time() - start_time)
+    return min(times) * 1000.0
+
+def spectrumRecords(count = 50):
+    """Interval records as written by the sinks (4096 channel lists)"""
+    random.seed(0)
+    return [{"deviceid": "000000-000000", "date": datetime(2014, 5, 1, 0, i % 60),
+             "realtime": 3600.0, "livetime": 3590.5, "cpm": 12.5, "counts": 1234,
+             "channels": [random.randint(0, 20) for c in range(4096)]} for i in range(count)]
+
+def benchRecords(jsonpickle, runs):
+    """Primitive lists flattened and restored in bulk"""
+    records = spectrumRecords()
+    encoded = jsonpickle.encode(records)
+    assert jsonpickle.decode(encoded) == records
+    return "50 spectrum records: encode %0.1f ms, decode %0.1f ms" % (best(lambda: jsonpickle.encode(records), runs),
+           best(lambda: jsonpickle.decode(encoded), runs))
+
+def nestedDocuments(count = 1000):
+    """Small documents of nested dicts, lists and tuples (39 containers each)"""
+    return [{"id": i, "meta": {"tags": ["a", "b"], "pos": {"lat": 1.5, "lon": [2.5, {"x": [i, (i, "y")]}]}},
+             "items": [{"k": j, "v": [j, {"w": [j, [j, [j]]]}]} for j in range(5)]} for i in range(count)]
+
+def benchNested(jsonpickle, runs):
+    """Container traversal of the Pickler and Unpickler"""
+    from jsonpickle.pickler import Pickler
+    from jsonpickle.unpickler import Unpickler
+    documents = nestedDocuments()
+    flat = jsonpickle.json.decode(jsonpickle.json.encode(Pickler().flatten(documents)))
+    return "1000 nested documents: flatten %0.1f ms, restore %0.1f ms" % (best(lambda: Pickler().flatten(documents), runs),
+           best(lambda: Unpickler().restore(flat), runs))
+
+def benchDeep(jsonpickle, runs):
+    """Nesting depth (the json backends have their own limit, so flatten/restore only)"""
+    from jsonpickle.pickler import Pickler
+    from jsonpickle.unpickler import Unpickler
+    deep = []
+    for i in range(20000):
+        deep = [deep, {"d": i}]
+    try:
+        flat = Pickler().flatten(deep)
+        Unpickler().restore(flat)
+    except RuntimeError as e: # RecursionError on Python 3
+        return "20000 deep: %s" % type(e).__name__
+    return "20000 deep: flatten %0.1f ms, restore %0.1f ms" % (best(lambda: Pickler().flatten(deep), runs),
+           best(lambda: Unpickler().restore(flat), runs))
+
+BENCHMARKS = [("records", benchRecords), ("nested", benchNested), ("deep", benchDeep)]
+
+# -----------------------------------------------------------------------------
+# Main
+# -----------------------------------------------------------------------------
+if __name__ == '__main__':
+  # Process command line options
+  parser = OptionParser("Usage: jsonpickle_bench.py [options] [<case> ...]")
+
+  parser.add_option("-p", "--path",
+                      type=str, dest="path", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir),
+                      help="specify the directory holding the jsonpickle package to benchmark (default this tree)")
+  parser.add_option("-n", "--runs",
+                      type=int, dest="runs", default=7,
+                      help="specify the number of runs of each case (default 7)")
+
+  (options, args) = parser.parse_args()
+
+  sys.path.insert(0, os.path.abspath(options.path))
+  import jsonpickle
+
+  print("python %d.%d, %s" % (sys.version_info[0], sys.version_info[1], os.path.dirname(jsonpickle.__file__)))
+  for name, benchmark in BENCHMARKS:
+    if not args or name in args:
+      print("%-8s %s" % (name, benchmark(jsonpickle, options.runs)))
@@ -64,16 +64,17 @@ added to JSON.
 """
 from jsonpickle import pickler
 from jsonpickle import unpickler
+from jsonpickle import backend
 from jsonpickle.backend import JSONBackend
 from jsonpickle.version import VERSION
 
 # ensure built-in handlers are loaded
 __import__('jsonpickle.handlers')
 
-__all__ = ('encode', 'decode')
+__all__ = ('encode', 'decode', 'encode_to', 'iterencode', 'iterdecode')
 __version__ = VERSION
 
-json = JSONBackend()
+json = backend.json
 
 # Export specific JSONPluginMgr methods into the jsonpickle namespace
 set_preferred_backend = json.set_preferred_backend
@@ -135,7 +136,54 @@ def encode(value,
                           max_depth=max_depth)
 
 
-def decode(string, backend=None, keys=False):
+def iterencode(value,
+               unpicklable=True, make_refs=True, keys=False,
+               max_depth=None, backend=None, chunk_size=64):
+    """
+    Generate the JSON formatted representation of value in pieces.
+
+    The pieces join into the string returned by encode() with the same
+    arguments.  A top-level list, tuple or set is flattened and encoded
+    'chunk_size' elements at a time, so that its JSON can be written out
+    before all of it has been produced.  Any other value comes in one piece.
+
+    >>> ''.join(iterencode([1, 2, 3], chunk_size=2)) == encode([1, 2, 3])
+    True
+
+    """
+    if backend is None:
+        backend = json
+    return pickler.iterencode(value,
+                              backend=backend,
+                              unpicklable=unpicklable,
+                              make_refs=make_refs,
+                              keys=keys,
+                              max_depth=max_depth,
+                              chunk_size=chunk_size)
+
+
+def encode_to(fp, value,
+              unpicklable=True, make_refs=True, keys=False,
+              max_depth=None, backend=None, chunk_size=64):
+    """
+    Write the JSON formatted representation of value to the file object fp.
+
+    This writes the output of iterencode() as it comes, so a large list
+    never exists as a single string.  See encode() for the other arguments.
+
+    """
+    if backend is None:
+        backend = json
+    pickler.encode_to(fp, value,
+                      backend=backend,
+                      unpicklable=unpicklable,
+                      make_refs=make_refs,
+                      keys=keys,
+                      max_depth=max_depth,
+                      chunk_size=chunk_size)
+
+
+def decode(string, backend=None, keys=False, legacy_refs=True):
     """
     Convert a JSON string into a Python object.
 
@@ -143,6 +191,11 @@ def decode(string, backend=None, keys=False):
     If set to True then jsonpickle will decode non-string dictionary keys
     into python objects via the jsonpickle protocol.
 
+    The keyword argument 'legacy_refs' defaults to True.
+    If set to False then the "py/ref" references written by old versions
+    of jsonpickle are not resolved, which saves tracking the path of every
+    object.  Documents written by this version only use "py/id".
+
     >>> str(decode('"my string"'))
     'my string'
     >>> decode('36')
@@ -150,4 +203,33 @@ def decode(string, backend=None, keys=False):
     """
     if backend is None:
         backend = json
-    return unpickler.decode(string, backend=backend, keys=keys)
+    return unpickler.decode(string, backend=backend, keys=keys,
+                            legacy_refs=legacy_refs)
+
+
+def iterdecode(source, backend=None, keys=False, legacy_refs=True,
+               lines=False, scoped=False, blocksize=65536):
+    """
+    Generate the Python objects of a top-level JSON array one at a time.
+
+    source is a JSON string or a file object opened in text mode.  Each
+    element is restored as soon as it has been read, so a large array
+    (such as a list written by encode_to()) never has to be held in
+    memory as a whole.  References between elements are kept unless
+    'scoped' is True, in which case each element gets its own references.
+
+    If 'lines' is True, source holds JSON lines instead: one document per
+    line, each with its own references.
+
+    A file object is read 'blocksize' characters at a time.
+
+    See decode() for the other arguments.
+
+    >>> list(iterdecode('[1, [2, 3]]'))
+    [1, [2, 3]]
+    """
+    if backend is None:
+        backend = json
+    return unpickler.iterdecode(source, backend=backend, keys=keys,
+                                legacy_refs=legacy_refs, lines=lines,
+                                scoped=scoped, blocksize=blocksize)
@@ -1,5 +1,19 @@
+import functools
+
 from jsonpickle.compat import PY32
 
+
+def _bind_options(encoder, optargs, optkwargs):
+    """Return a one argument function calling encoder with the options"""
+    optargs = tuple(optargs)
+    optkwargs = dict(optkwargs)
+    if optargs:
+        return lambda obj: encoder(obj, *optargs, **optkwargs)
+    if optkwargs:
+        return functools.partial(encoder, **optkwargs)
+    return encoder
+
+
 class JSONBackend(object):
     """Manages encoding and decoding using various backends.
 
@@ -21,6 +35,9 @@ class JSONBackend(object):
         self._encoders = {}
         self._decoders = {}
 
+        ## A dictionary mapping backend names to their modules
+        self._modules = {}
+
         ## Options to pass to specific encoders
         json_opts = ((), {'sort_keys': True})
         self._encoder_options = {
@@ -35,6 +52,13 @@ class JSONBackend(object):
         ## Whether we've loaded any backends successfully
         self._verified = False
 
+        ## Encode/decode functions of each backend with their options
+        ## bound, in the order they are tried.  Rebuilt by _update()
+        ## whenever a backend, an option or the order changes.
+        self._encoder_chain = []
+        self._decoder_chain = []
+        self._encode_fast = {}
+
         if not PY32:
             self.load_backend('simplejson', 'dumps', 'loads', ValueError)
         self.load_backend('json', 'dumps', 'loads', ValueError)
@@ -43,6 +67,28 @@ class JSONBackend(object):
         self.load_backend('yajl', 'dumps', 'loads', ValueError)
         self.load_backend('ujson', 'dumps', 'loads', ValueError)
 
+    def _update(self):
+        """Bind the options of each backend to its encode function
+
+        >>> backend = JSONBackend()
+        >>> backend.set_encoder_options('json', sort_keys=True,
+        ...                             separators=(',', ':'))
+        >>> backend.set_preferred_backend('json')
+        >>> print(backend.encode({'b': [1, 2], 'a': 3}))
+        {"a":3,"b":[1,2]}
+
+        """
+        self._encode_fast = {}
+        for name in self._backend_names:
+            optargs, optkwargs = self._encoder_options[name]
+            self._encode_fast[name] = _bind_options(self._encoders[name],
+                                                    optargs, optkwargs)
+        self._encoder_chain = [self._encode_fast[name]
+                               for name in self._backend_names]
+        self._decoder_chain = [(self._decoders[name],
+                                self._decoder_exceptions[name])
+                               for name in self._backend_names]
+
     def _verify(self):
         """Ensures that we've loaded at least one JSON backend."""
         if self._verified:
@@ -104,6 +150,7 @@ class JSONBackend(object):
             ## Setup the backend's encode/decode methods
             self._encoders[name] = getattr(mod, encode_name)
             self._decoders[name] = getattr(mod, decode_name)
+            self._modules[name] = mod
         except AttributeError:
             self.remove_backend(name)
             return
@@ -127,16 +174,19 @@ class JSONBackend(object):
 
         ## Indicate that we successfully loaded a JSON backend
         self._verified = True
+        self._update()
 
     def remove_backend(self, name):
         """Remove all entries for a particular backend."""
         self._encoders.pop(name, None)
         self._decoders.pop(name, None)
+        self._modules.pop(name, None)
         self._decoder_exceptions.pop(name, None)
         self._encoder_options.pop(name, None)
         if name in self._backend_names:
             self._backend_names.remove(name)
         self._verified = bool(self._backend_names)
+        self._update()
 
     def encode(self, obj):
         """
@@ -148,25 +198,20 @@ class JSONBackend(object):
         """
         self._verify()
 
+        encoders = self._encoder_chain
         if not self._fallthrough:
-            name = self._backend_names[0]
-            return self.backend_encode(name, obj)
+            return encoders[0](obj)
 
-        for idx, name in enumerate(self._backend_names):
+        last = len(encoders) - 1
+        for idx, encoder in enumerate(encoders):
             try:
-                optargs, optkwargs = self._encoder_options[name]
-                encoder_kwargs = optkwargs.copy()
-                encoder_args = (obj,) + tuple(optargs)
-                return self._encoders[name](*encoder_args, **encoder_kwargs)
+                return encoder(obj)
             except Exception:
-                if idx == len(self._backend_names) - 1:
+                if idx == last:
                     raise
 
     def backend_encode(self, name, obj):
-        optargs, optkwargs = self._encoder_options[name]
-        encoder_kwargs = optkwargs.copy()
-        encoder_args = (obj,) + tuple(optargs)
-        return self._encoders[name](*encoder_args, **encoder_kwargs)
+        return self._encode_fast[name](obj)
 
     def decode(self, string):
         """
@@ -178,15 +223,16 @@ class JSONBackend(object):
         """
         self._verify()
 
+        decoders = self._decoder_chain
         if not self._fallthrough:
-            name = self._backend_names[0]
-            return self.backend_decode(name, string)
+            return decoders[0][0](string)
 
-        for idx, name in enumerate(self._backend_names):
+        last = len(decoders) - 1
+        for idx, (decoder, exc) in enumerate(decoders):
             try:
-                return self.backend_decode(name, string)
-            except self._decoder_exceptions[name] as e:
-                if idx == len(self._backend_names) - 1:
+                return decoder(string)
+            except exc as e:
+                if idx == last:
                     raise e
                 else:
                     pass # and try a more forgiving encoder, e.g. demjson
@@ -194,6 +240,23 @@ class JSONBackend(object):
     def backend_decode(self, name, string):
         return self._decoders[name](string)
 
+    def raw_decoder(self):
+        """
+        Return the raw_decode(string, pos) function of the preferred backend.
+
+        It decodes the JSON value starting at pos in a larger string and
+        returns it with the position where it ends.  Only the backends
+        with a JSONDecoder class (simplejson, json) have one, None is
+        returned for the others.
+
+        """
+        self._verify()
+        mod = self._modules[self._backend_names[0]]
+        decoder_class = getattr(mod, 'JSONDecoder', None)
+        if decoder_class is None:
+            return None
+        return decoder_class().raw_decode
+
     def set_preferred_backend(self, name):
         """
         Set the preferred json backend.
@@ -215,6 +278,7 @@ class JSONBackend(object):
         if name in self._backend_names:
             self._backend_names.remove(name)
             self._backend_names.insert(0, name)
+            self._update()
         else:
             errmsg = 'The "%s" backend has not been loaded.' % name
             raise AssertionError(errmsg)
@@ -237,3 +301,10 @@ class JSONBackend(object):
 
         """
         self._encoder_options[name] = (args, kwargs)
+        self._update()
+
+
+## The backend used by jsonpickle.encode()/decode() and by any Pickler or
+## Unpickler created without one, so that the available JSON modules are
+## only looked up once
+json = JSONBackend()
@@ -21,19 +21,31 @@ objects that implement the reduce protocol::
 """
 
 import sys
+import zlib
+import array
 import datetime
 import time
 import collections
 import decimal
 
 from jsonpickle import util
-from jsonpickle.compat import unicode
+from jsonpickle import tags
+from jsonpickle.compat import unicode, bytes, PY3
+
+# numpy is optional, arrays are only handled when it is available
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 class Registry(object):
 
     def __init__(self):
         self._handlers = {}
+        ## Incremented on each registration so that the per-type caches
+        ## of the pickler can tell when they are stale
+        self.version = 0
 
     def register(self, cls, handler):
         """Register the a custom handler for a class
@@ -43,6 +55,7 @@ class Registry(object):
 
         """
         self._handlers[cls] = handler
+        self.version += 1
 
     def get(self, cls):
         return self._handlers.get(cls)
@@ -175,3 +188,206 @@ if sys.version_info >= (2, 7):
 
 if sys.version_info >= (3, 0):
     SimpleReduceHandler.handles(decimal.Decimal)
+
+
+
+def _buffer(obj):
+    """Return a flat byte view of a C-contiguous buffer, without copying it
+
+    >>> len(_buffer(array.array('H', [1, 2])))
+    4
+
+    """
+    if PY3:
+        return memoryview(obj).cast('B')
+    return buffer(obj)
+
+
+class BufferHandler(BaseHandler):
+    """Base class of the handlers writing a binary buffer in base64
+
+    The buffer is encoded straight from a view of the object's memory and
+    restored in one C-level call, without a Python loop over the items.
+    Set `compress` to True (on this class or a subclass) to zlib-compress
+    the buffers of at least `compress_min_size` bytes; both forms are
+    restored.  With unpicklable=False the values are written as plain
+    lists, as they were before these handlers.
+
+    """
+    compress = False
+    compress_min_size = 1024
+
+    def flatten_buffer(self, buf, data):
+        if self.compress and len(buf) >= self.compress_min_size:
+            buf = zlib.compress(buf)
+            data['compression'] = 'zlib'
+        data['data'] = util.b64encode(buf)
+        return data
+
+    def restore_buffer(self, obj):
+        payload = util.b64decode(obj['data'])
+        if obj.get('compression') == 'zlib':
+            payload = zlib.decompress(payload)
+        return payload
+
+
+class BytesHandler(BufferHandler):
+    """Custom handler for Python 3 bytes
+
+    Python 2 str are text and never reach the handlers when flattening,
+    bytes written by Python 3 are restored as str.
+
+    """
+    def flatten(self, obj, data):
+        if not self.context.unpicklable:
+            return list(obj)
+        return self.flatten_buffer(obj, data)
+
+    def restore(self, obj):
+        return bytes(self.restore_buffer(obj))
+
+
+class BytearrayHandler(BufferHandler):
+    """Custom handler for bytearray
+
+    bytearray used to be written as a "py/seq" list of integers, which is
+    still restored.
+
+    """
+    def flatten(self, obj, data):
+        if not self.context.unpicklable:
+            return list(obj)
+        return self.flatten_buffer(_buffer(obj), data)
+
+    def restore(self, obj):
+        if tags.SEQ in obj:
+            return bytearray(obj[tags.SEQ])
+        return bytearray(self.restore_buffer(obj))
+
+
+class ArrayHandler(BufferHandler):
+    """Custom handler for array.array
+
+    The items are written in the machine byte order, which is recorded
+    and swapped back on restore if needed.  Type codes whose size depends
+    on the platform ('l', 'L') need the same size on both ends.
+
+    Arrays used to be written as a "py/seq" list of their items without
+    the type code, which is still restored with a type code guessed from
+    the items ('d' for numbers with a float, 'u' for characters, 'l'
+    otherwise).
+
+    """
+    def flatten(self, obj, data):
+        if not self.context.unpicklable:
+            return obj.tolist()
+        data['typecode'] = obj.typecode
+        data['byteorder'] = sys.byteorder
+        return self.flatten_buffer(_buffer(obj), data)
+
+    def restore(self, obj):
+        if tags.SEQ in obj:
+            items = obj[tags.SEQ]
+            typecode = 'l'
+            if any(isinstance(item, float) for item in items):
+                typecode = 'd'
+            elif any(isinstance(item, (str, unicode)) for item in items):
+                typecode = 'u'
+            return array.array(str(typecode), items)
+        value = array.array(str(obj['typecode']))
+        payload = self.restore_buffer(obj)
+        if PY3:
+            value.frombytes(payload)
+        else:
+            value.fromstring(payload)
+        if obj['byteorder'] != sys.byteorder:
+            value.byteswap()
+        return value
+
+
+class NumpyHandler(BufferHandler):
+    """Custom handler for numpy.ndarray
+
+    The dtype (including its byte order) and the shape are written with
+    the C-ordered buffer of the array, which is restored as a writable
+    array with numpy.frombuffer().  Arrays of Python objects have no
+    meaningful buffer and are written as nested lists instead.
+
+    """
+    def flatten(self, obj, data):
+        if not self.context.unpicklable:
+            return self.context.flatten(obj.tolist(), reset=False)
+        dtype = obj.dtype
+        data['shape'] = list(obj.shape)
+        if dtype.hasobject:
+            data['dtype'] = dtype.str
+            data['values'] = self.context.flatten(obj.tolist(), reset=False)
+            return data
+        if dtype.fields:
+            data['dtype'] = _descr_to_list(dtype.descr)
+        else:
+            data['dtype'] = dtype.str
+        obj = numpy.ascontiguousarray(obj)
+        return self.flatten_buffer(_buffer(obj), data)
+
+    def restore(self, obj):
+        dtype = numpy.dtype(_descr(obj['dtype']))
+        shape = tuple(obj['shape'])
+        if 'values' in obj:
+            values = self.context.restore(obj['values'], reset=False)
+            value = numpy.empty(shape, dtype=dtype)
+            value[...] = values
+            return value
+        payload = self.restore_buffer(obj)
+        if not payload:
+            return numpy.empty(shape, dtype=dtype)
+        # A bytearray makes the array writable (bytes would be read-only)
+        return numpy.frombuffer(bytearray(payload), dtype=dtype).reshape(shape)
+
+
+def _descr_to_list(descr):
+    """Return the JSON form of a numpy dtype description
+
+    >>> _descr_to_list([('a', '<i4'), ('b', [('c', '|u1')], (2,))])
+    [['a', '<i4'], ['b', [['c', '|u1']], [2]]]
+
+    """
+    if not isinstance(descr, list):
+        return descr
+    return [[field[0], _descr_to_list(field[1])] + [list(x) for x in field[2:]]
+            for field in descr]
+
+
+def _descr(descr):
+    """Rebuild a numpy dtype description from its JSON form
+
+    Structured dtypes are lists of (name, format[, shape]) fields, which
+    JSON turns into lists.
+
+    >>> _descr('<f8')
+    '<f8'
+    >>> _descr([['a', '<i4'], ['b', [['c', '|u1']], [2]]])
+    [('a', '<i4'), ('b', [('c', '|u1')], (2,))]
+
+    """
+    if not isinstance(descr, list):
+        return str(descr)
+    fields = []
+    for field in descr:
+        name, fmt = str(field[0]), _descr(field[1])
+        if len(field) > 2:
+            fields.append((name, fmt, tuple(field[2])))
+        else:
+            fields.append((name, fmt))
+    return fields
+
+
+if PY3:
+    BytesHandler.handles(bytes)
+else:
+    # Restore the bytes written by Python 3 as str
+    BytesHandler.handles(str)
+BytearrayHandler.handles(bytearray)
+ArrayHandler.handles(array.array)
+if numpy is not None:
+    NumpyHandler.handles(numpy.ndarray)
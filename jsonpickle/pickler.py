@@ -7,11 +7,13 @@
 # This software is licensed as described in the file COPYING, which
 # you should have received as part of this distribution.
 
+import weakref
+
 import jsonpickle.util as util
 import jsonpickle.tags as tags
 import jsonpickle.handlers as handlers
 
-from jsonpickle.backend import JSONBackend
+import jsonpickle.backend
 from jsonpickle.compat import unicode
 
 
@@ -29,9 +31,113 @@ def encode(value,
     return backend.encode(context.flatten(value, reset=reset))
 
 
+def iterencode(value,
+               unpicklable=False, make_refs=True, keys=False,
+               max_depth=None, backend=None, context=None,
+               chunk_size=64):
+    """Generate the JSON representation of value piece by piece
+
+    A top-level list, tuple or set is flattened and encoded chunk_size
+    elements at a time by the same Pickler, so references between the
+    elements are kept, and only one chunk is held in memory.  The pieces
+    join into the string returned by encode().
+
+    >>> list(iterencode([1, 'a', {'b': None}], chunk_size=2))
+    ['[', '1, "a"', ', {"b": null}', ']']
+    >>> ''.join(iterencode((1, 2), unpicklable=True, chunk_size=1))
+    '{"py/tuple": [1, 2]}'
+    >>> list(iterencode({'a': 1}))
+    ['{"a": 1}']
+
+    """
+    backend = _make_backend(backend)
+    if context is None:
+        context = Pickler(unpicklable=unpicklable,
+                          make_refs=make_refs,
+                          keys=keys,
+                          backend=backend,
+                          max_depth=max_depth)
+    wrap = _sequence_wrapper(context, value)
+    if wrap is None or not value or context._max_depth == 0:
+        yield backend.encode(context.flatten(value))
+        return
+
+    prefix, separator, suffix = _sequence_frame(backend, wrap)
+    # Same steps as flatten() for the sequence itself, then its elements
+    context.reset()
+    context._push()
+    context._seen.append(value)
+    if util.is_list(value):
+        context._mkref(value)
+    yield prefix
+    items = []
+    first = True
+    for v in value:
+        items.append(context._flatten(v))
+        if len(items) == chunk_size:
+            yield _sequence_body(backend, wrap, items, prefix, separator,
+                                 suffix, first)
+            items = []
+            first = False
+    if items:
+        yield _sequence_body(backend, wrap, items, prefix, separator,
+                             suffix, first)
+    yield suffix
+    context._pop(None)
+
+
+def encode_to(fp, value,
+              unpicklable=False, make_refs=True, keys=False,
+              max_depth=None, backend=None, context=None,
+              chunk_size=64):
+    """Write the JSON representation of value to the file object fp"""
+    for chunk in iterencode(value,
+                            unpicklable=unpicklable,
+                            make_refs=make_refs,
+                            keys=keys,
+                            max_depth=max_depth,
+                            backend=backend,
+                            context=context,
+                            chunk_size=chunk_size):
+        fp.write(chunk)
+
+
+def _sequence_wrapper(pickler, obj):
+    """Return how the flattened elements of obj are wrapped, None if obj
+    is not a list, tuple or set"""
+    if util.is_list(obj):
+        return list
+    if util.is_tuple(obj) or util.is_set(obj):
+        if not pickler.unpicklable:
+            return list
+        tag = util.is_tuple(obj) and tags.TUPLE or tags.SET
+        return lambda items: {tag: items}
+    return None
+
+
+def _sequence_frame(backend, wrap):
+    """Find the opening, separator and closing strings the backend
+    writes around the elements of a wrapped sequence"""
+    one = backend.encode(wrap([None]))
+    two = backend.encode(wrap([None, None]))
+    start = one.index('null')
+    end = start + len('null')
+    prefix, suffix = one[:start], one[end:]
+    separator = two[end:len(two) - len(suffix) - len('null')]
+    return prefix, separator, suffix
+
+
+def _sequence_body(backend, wrap, items, prefix, separator, suffix, first):
+    encoded = backend.encode(wrap(items))
+    body = encoded[len(prefix):len(encoded) - len(suffix)]
+    if first:
+        return body
+    return separator + body
+
+
 def _make_backend(backend):
     if backend is None:
-        return JSONBackend()
+        return jsonpickle.backend.json
     else:
         return backend
 
@@ -53,11 +159,14 @@ class Pickler(object):
         self._objs = {}
         ## Avoids garbage collection
         self._seen = []
+        ## ids of the containers being flattened by _flatten()
+        self._open = set()
 
     def reset(self):
         self._objs = {}
         self._depth = -1
         self._seen = []
+        self._open = set()
 
     def _push(self):
         """Steps down one level in the namespace.
@@ -121,8 +230,134 @@ class Pickler(object):
         return self._flatten(obj)
 
     def _flatten(self, obj):
+        """Flatten obj one level down
+
+        Lists, tuples, sets and dicts are walked with an explicit stack of
+        frames instead of recursive calls, so deeply nested containers do
+        not grow the Python stack.  Each frame is [items iterator, output
+        list or dict, True if the items are key/value pairs, key of the
+        item being flattened, tag wrapping the output or None, id of the
+        container].  A container met again while it is still open is a
+        cycle that references did not break and becomes its repr().
+
+        >>> p = Pickler()
+        >>> p.flatten([1, {'a': [2, (3,)]}, []])
+        [1, {'a': [2, {'py/tuple': [3]}]}, []]
+        >>> deep = []
+        >>> for i in range(5000):
+        ...     deep = [deep]
+        >>> flat = p.flatten(deep)
+        >>> for i in range(5000):
+        ...     flat = flat[0]
+        >>> flat
+        []
+        >>> d = {}
+        >>> d['self'] = d
+        >>> p.flatten(d)
+        {'self': "{'self': {...}}"}
+        """
         self._push()
-        return self._pop(self._flatten_obj(obj))
+        value, frame = self._flatten_enter(obj)
+        if frame is None:
+            return self._pop(value)
+        flatteners = _dispatch._flatteners
+        max_depth = self._max_depth
+        reserved = tags.RESERVED
+        stack = [frame]
+        while True:
+            frame = stack[-1]
+            items, data, pairs = frame[0], frame[1], frame[2]
+            k = None
+            for item in items:
+                if pairs:
+                    k, v = item
+                    primitive = flatteners.get(type(v)) is _flatten_primitive
+                    # util.is_picklable(), primitives are never functions
+                    if k in reserved or (not primitive and
+                                         util.is_function(v)):
+                        continue
+                    if not isinstance(k, (str, unicode)):
+                        k = self._flatten_key(k)
+                else:
+                    v = item
+                    primitive = flatteners.get(type(v)) is _flatten_primitive
+                if primitive and self._depth + 1 != max_depth:
+                    # primitives flatten to themselves
+                    value = v
+                else:
+                    self._depth += 1
+                    value, child = self._flatten_enter(v)
+                    if child is not None:
+                        # step into the child, this frame resumes after it
+                        frame[3] = k
+                        stack.append(child)
+                        break
+                    self._depth -= 1
+                if pairs:
+                    data[k] = value
+                else:
+                    data.append(value)
+            else:
+                # all items done, hand the result to the parent frame
+                stack.pop()
+                self._open.discard(frame[5])
+                if frame[4] is not None:
+                    data = {frame[4]: data}
+                if not stack:
+                    return self._pop(data)
+                self._depth -= 1
+                parent = stack[-1]
+                if parent[2]:
+                    parent[1][parent[3]] = data
+                else:
+                    parent[1].append(data)
+
+    def _flatten_enter(self, obj):
+        """Start flattening obj at the current depth
+
+        Return (value, None) when obj is done, as _flatten_obj() would
+        return it, or (None, frame) when obj is a container whose items
+        remain to be flattened.
+        """
+        self._seen.append(obj)
+        max_reached = self._depth == self._max_depth
+
+        if max_reached or (not self.make_refs and id(obj) in self._objs):
+            # break the cycle
+            return repr(obj), None
+
+        strategy = _dispatch.flattener(obj)
+        if strategy is _flatten_primitive:
+            return obj, None
+        objid = id(obj)
+        if strategy is _flatten_dict:
+            if objid in self._open:
+                return repr(obj), None
+            self._open.add(objid)
+            items = iter(sorted(obj.items(), key=util.itemgetter))
+            return None, [items, {}, True, None, None, objid]
+        if strategy is _flatten_list:
+            if not self._mkref(obj):
+                self._push()
+                return self._getref(obj), None
+            wrap = None
+        elif strategy is _flatten_tuple or strategy is _flatten_set:
+            wrap = None
+            if self.unpicklable:
+                wrap = strategy is _flatten_tuple and tags.TUPLE or tags.SET
+        else:
+            return strategy(self, obj), None
+
+        # Same fast path as _list_recurse()
+        if ((self._max_depth is None or self._depth + 1 < self._max_depth) and
+                util.is_primitive_sequence(obj)):
+            if wrap is None:
+                return list(obj), None
+            return {wrap: list(obj)}, None
+        if objid in self._open:
+            return repr(obj), None
+        self._open.add(objid)
+        return None, [iter(obj), [], False, None, wrap, objid]
 
     def _flatten_obj(self, obj):
         self._seen.append(obj)
@@ -130,51 +365,24 @@ class Pickler(object):
 
         if max_reached or (not self.make_refs and id(obj) in self._objs):
             # break the cycle
-            flatten_func = repr
-        else:
-            flatten_func = self._get_flattener(obj)
+            return repr(obj)
 
-        return flatten_func(obj)
+        return _dispatch.flattener(obj)(self, obj)
 
     def _list_recurse(self, obj):
+        # Fast path: primitives flatten to themselves, unless the next
+        # level reaches max_depth where they become repr() strings.  They
+        # never get a reference id so they need not be kept in _seen.
+        if ((self._max_depth is None or self._depth + 1 < self._max_depth) and
+                util.is_primitive_sequence(obj)):
+            return list(obj)
         return [self._flatten(v) for v in obj]
 
     def _get_flattener(self, obj):
-
-        if util.is_primitive(obj):
-            return lambda obj: obj
-
-        list_recurse = self._list_recurse
-
-        if util.is_list(obj):
-            if self._mkref(obj):
-                return list_recurse
-            else:
-                self._push()
-                return self._getref
-
-        # We handle tuples and sets by encoding them in a "(tuple|set)dict"
-        if util.is_tuple(obj):
-            if not self.unpicklable:
-                return list_recurse
-            return lambda obj: {tags.TUPLE: [self._flatten(v) for v in obj]}
-
-        if util.is_set(obj):
-            if not self.unpicklable:
-                return list_recurse
-            return lambda obj: {tags.SET: [self._flatten(v) for v in obj]}
-
-        if util.is_dictionary(obj):
-            return self._flatten_dict_obj
-
-        if util.is_type(obj):
-            return _mktyperef
-
-        if util.is_object(obj):
-            return self._ref_obj_instance
-
-        # else, what else? (methods, functions, old style classes...)
-        return None
+        strategy = _dispatch.flattener(obj)
+        if strategy is None:
+            return None
+        return lambda obj: strategy(self, obj)
 
     def _ref_obj_instance(self, obj):
         """Reference an existing object or flatten if new
@@ -182,7 +390,16 @@ class Pickler(object):
         if self._mkref(obj):
             # We've never seen this object so return its
             # json representation.
-            return self._flatten_obj_instance(obj)
+            if not (self.make_refs and self.unpicklable):
+                return self._flatten_obj_instance(obj)
+            # The containers reached again through this object are not
+            # cycles for _flatten(): the object's py/id breaks them.
+            opened = self._open
+            self._open = set()
+            try:
+                return self._flatten_obj_instance(obj)
+            finally:
+                self._open = opened
         # We've seen this object before so place an object
         # reference tag in the data. This avoids infinite recursion
         # when processing cyclical objects.
@@ -192,25 +409,20 @@ class Pickler(object):
         """Recursively flatten an instance and return a json-friendly dict
         """
         data = {}
-        has_class = hasattr(obj, '__class__')
-        has_dict = hasattr(obj, '__dict__')
-        has_slots = not has_dict and hasattr(obj, '__slots__')
-
-        # Support objects with __getstate__(); this ensures that
-        # both __setstate__() and __getstate__() are implemented
-        has_getstate = hasattr(obj, '__getstate__')
-        has_getstate_support = has_getstate and hasattr(obj, '__setstate__')
+        traits = _dispatch.traits(obj)
+        has_dict = traits.has_dict
+        has_slots = traits.has_slots
+        has_getstate_support = traits.has_getstate_support
 
-        if has_class and not util.is_module(obj):
-            module, name = _getclassdetail(obj)
+        if traits.has_class and not traits.is_module:
             if self.unpicklable:
-                data[tags.OBJECT] = '%s.%s' % (module, name)
+                data[tags.OBJECT] = traits.classname
             # Check for a custom handler
-            handler = handlers.get(type(obj))
+            handler = traits.handler
             if handler is not None:
                 return handler(self).flatten(obj, data)
 
-        if util.is_module(obj):
+        if traits.is_module:
             if self.unpicklable:
                 data[tags.REPR] = '%s/%s' % (obj.__name__,
                                              obj.__name__)
@@ -218,7 +430,7 @@ class Pickler(object):
                 data = unicode(obj)
             return data
 
-        if util.is_dictionary_subclass(obj):
+        if traits.is_dictionary_subclass:
             self._flatten_dict_obj(obj, data)
             if has_getstate_support:
                 self._getstate(obj, data)
@@ -226,7 +438,7 @@ class Pickler(object):
 
         if has_dict:
             # Support objects that subclasses list and set
-            if util.is_sequence_subclass(obj):
+            if traits.is_sequence_subclass:
                 return self._flatten_sequence_obj(obj, data)
 
             if has_getstate_support:
@@ -236,10 +448,10 @@ class Pickler(object):
             getattr(obj, '_', None)
             return self._flatten_dict_obj(obj.__dict__, data)
 
-        if util.is_sequence_subclass(obj):
+        if traits.is_sequence_subclass:
             return self._flatten_sequence_obj(obj, data)
 
-        if util.is_noncomplex(obj):
+        if traits.is_noncomplex:
             return [self._flatten(v) for v in obj]
 
         if has_slots:
@@ -273,19 +485,22 @@ class Pickler(object):
         if not util.is_picklable(k, v):
             return data
         if not isinstance(k, (str, unicode)):
-            if self.keys:
-                k = tags.JSON_KEY + encode(k,
-                                           reset=False, keys=True,
-                                           context=self, backend=self.backend,
-                                           make_refs=self.make_refs)
-            else:
-                try:
-                    k = repr(k)
-                except:
-                    k = unicode(k)
+            k = self._flatten_key(k)
         data[k] = self._flatten(v)
         return data
 
+    def _flatten_key(self, k):
+        """Return the string used as JSON key for a non-string key"""
+        if self.keys:
+            return tags.JSON_KEY + encode(k,
+                                          reset=False, keys=True,
+                                          context=self, backend=self.backend,
+                                          make_refs=self.make_refs)
+        try:
+            return repr(k)
+        except:
+            return unicode(k)
+
     def _flatten_sequence_obj(self, obj, data):
         """Return a json-friendly dict for a sequence subclass."""
         if hasattr(obj, '__dict__'):
@@ -306,6 +521,183 @@ class Pickler(object):
         return data
 
 
+#
+# Per-type dispatch
+#
+# The flattening strategy of a value and the class traits probed by
+# _flatten_obj_instance only depend on its type, so they are resolved once
+# per type and cached. Registering a handler invalidates the caches.
+# Classes created at runtime are only weakly referenced by the caches, so
+# caching them does not keep them alive.
+#
+
+def _flatten_primitive(pickler, obj):
+    return obj
+
+
+def _flatten_list(pickler, obj):
+    if pickler._mkref(obj):
+        return pickler._list_recurse(obj)
+    pickler._push()
+    return pickler._getref(obj)
+
+
+# We handle tuples and sets by encoding them in a "(tuple|set)dict"
+def _flatten_tuple(pickler, obj):
+    if not pickler.unpicklable:
+        return pickler._list_recurse(obj)
+    return {tags.TUPLE: pickler._list_recurse(obj)}
+
+
+def _flatten_set(pickler, obj):
+    if not pickler.unpicklable:
+        return pickler._list_recurse(obj)
+    return {tags.SET: pickler._list_recurse(obj)}
+
+
+def _flatten_dict(pickler, obj):
+    return pickler._flatten_dict_obj(obj)
+
+
+def _flatten_type(pickler, obj):
+    return _mktyperef(obj)
+
+
+def _flatten_instance(pickler, obj):
+    return pickler._ref_obj_instance(obj)
+
+
+def _resolve_flattener(obj):
+    if util.is_primitive(obj):
+        return _flatten_primitive
+    if util.is_list(obj):
+        return _flatten_list
+    if util.is_tuple(obj):
+        return _flatten_tuple
+    if util.is_set(obj):
+        return _flatten_set
+    if util.is_dictionary(obj):
+        return _flatten_dict
+    if util.is_type(obj):
+        return _flatten_type
+    if util.is_object(obj):
+        return _flatten_instance
+    # else, what else? (methods, functions, old style classes...)
+    return None
+
+
+class _ClassTraits(object):
+    """What _flatten_obj_instance needs to know about a class"""
+
+    def __init__(self, obj):
+        self.has_class = hasattr(obj, '__class__')
+        self.has_dict = hasattr(obj, '__dict__')
+        self.has_slots = not self.has_dict and hasattr(obj, '__slots__')
+        # Support objects with __getstate__(); this ensures that
+        # both __setstate__() and __getstate__() are implemented
+        self.has_getstate_support = (hasattr(obj, '__getstate__') and
+                                     hasattr(obj, '__setstate__'))
+        self.is_module = util.is_module(obj)
+        self.classname = None
+        self.handler = None
+        if self.has_class and not self.is_module:
+            self.classname = '%s.%s' % _getclassdetail(obj)
+            self.handler = handlers.get(type(obj))
+        self.is_dictionary_subclass = util.is_dictionary_subclass(obj)
+        self.is_sequence_subclass = util.is_sequence_subclass(obj)
+        self.is_noncomplex = util.is_noncomplex(obj)
+
+
+## Py_TPFLAGS_HEAPTYPE: the type was created at runtime (class statement)
+_HEAPTYPE = 1 << 9
+
+
+class _DispatchCache(object):
+
+    def __init__(self):
+        self._version = handlers.registry.version
+        ## Builtin types, which live as long as the interpreter
+        self._flatteners = {}
+        self._traits = {}
+        ## Heap types, weakly referenced
+        self._heap_flatteners = weakref.WeakKeyDictionary()
+        self._heap_traits = weakref.WeakKeyDictionary()
+
+    def _validate(self):
+        if self._version != handlers.registry.version:
+            self._flatteners = {}
+            self._traits = {}
+            self._heap_flatteners = weakref.WeakKeyDictionary()
+            self._heap_traits = weakref.WeakKeyDictionary()
+            self._version = handlers.registry.version
+
+    def flattener(self, obj):
+        """Return the strategy function(pickler, obj) for the type of obj
+
+        >>> _dispatch.flattener([1]) is _flatten_list
+        True
+        >>> _dispatch.flattener(None) is _flatten_primitive
+        True
+        """
+        self._validate()
+        cls = type(obj)
+        try:
+            return self._flatteners[cls]
+        except KeyError:
+            pass
+        if not cls.__flags__ & _HEAPTYPE:
+            strategy = self._flatteners[cls] = _resolve_flattener(obj)
+            return strategy
+        try:
+            return self._heap_flatteners[cls]
+        except KeyError:
+            strategy = self._heap_flatteners[cls] = _resolve_flattener(obj)
+            return strategy
+
+    def traits(self, obj):
+        """Return the _ClassTraits of obj
+
+        Old-style instances all share the same type, so the key includes
+        the class too.
+
+        >>> class Example(object): pass
+        >>> _dispatch.traits(Example()).classname
+        'jsonpickle.pickler.Example'
+        >>> del Example
+        >>> import gc; _ = gc.collect()
+        >>> [t for t in _dispatch._heap_traits if t.__name__ == 'Example']
+        []
+        """
+        self._validate()
+        cls = type(obj)
+        klass = getattr(obj, '__class__', None)
+        if klass is None or klass is cls:
+            if not cls.__flags__ & _HEAPTYPE:
+                try:
+                    return self._traits[cls]
+                except KeyError:
+                    traits = self._traits[cls] = _ClassTraits(obj)
+                    return traits
+            klass = cls
+        try:
+            by_class = self._heap_traits[cls]
+        except KeyError:
+            by_class = self._heap_traits[cls] = weakref.WeakKeyDictionary()
+        except TypeError:
+            return _ClassTraits(obj)
+        try:
+            return by_class[klass]
+        except KeyError:
+            traits = by_class[klass] = _ClassTraits(obj)
+            return traits
+        except TypeError:
+            # __class__ is not a class (proxy objects)
+            return _ClassTraits(obj)
+
+
+_dispatch = _DispatchCache()
+
+
 def _mktyperef(obj):
     """Return a typeref dictionary
 
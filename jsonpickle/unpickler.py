@@ -7,27 +7,159 @@
 # This software is licensed as described in the file COPYING, which
 # you should have received as part of this distribution.
 
+import re
 import sys
+import json
+import threading
 
 import jsonpickle.util as util
 import jsonpickle.tags as tags
 import jsonpickle.handlers as handlers
 
 from jsonpickle.compat import set
-from jsonpickle.backend import JSONBackend
+import jsonpickle.backend
 
 
 def decode(string, backend=None, context=None, keys=False, reset=True,
-           safe=False):
+           safe=False, legacy_refs=True):
     backend = _make_backend(backend)
     if context is None:
-        context = Unpickler(keys=keys, backend=backend, safe=safe)
+        context = Unpickler(keys=keys, backend=backend, safe=safe,
+                            legacy_refs=legacy_refs)
     return context.restore(backend.decode(string), reset=reset)
 
 
+def iterdecode(source, backend=None, context=None, keys=False, safe=False,
+               legacy_refs=True, lines=False, scoped=False,
+               blocksize=65536):
+    """Restore the elements of a top-level JSON array one at a time
+
+    source is a string or a file object opened in text mode, read
+    blocksize characters at a time.  The array is split into its elements
+    by the preferred backend, each element being restored as soon as it
+    has been read.  Backends which cannot decode part of a string
+    (demjson, yajl, ujson...) are replaced by the standard json module
+    for that.  References between elements are kept, as with decode(),
+    unless scoped is True: the reference table is then reset for each
+    element, which keeps it small when the elements were encoded
+    separately.
+
+    With lines=True source holds JSON lines instead, one document per
+    line decoded by the backend, each with its own references.
+
+    >>> list(iterdecode('[1, 2.5, [null, true]]'))
+    [1, 2.5, [None, True]]
+    >>> doc = '[{"py/object": "jsonpickle._samples.Thing"}, {"py/id": 1}]'
+    >>> a, b = iterdecode(doc)
+    >>> a is b
+    True
+    >>> list(iterdecode('[1, 2]\\n\\n[3]\\n', lines=True))
+    [[1, 2], [3]]
+
+    """
+    backend = _make_backend(backend)
+    if context is None:
+        context = Unpickler(keys=keys, backend=backend, safe=safe,
+                            legacy_refs=legacy_refs)
+    if lines:
+        if not hasattr(source, 'read'):
+            source = source.splitlines()
+        for line in source:
+            if line.strip():
+                yield context.restore(backend.decode(line), reset=True)
+        return
+
+    if not scoped:
+        # The array itself takes the first reference id, as with decode()
+        context.reset()
+        context._mkref([])
+    raw_decode = backend.raw_decoder()
+    for item in _array_items(source, blocksize, raw_decode):
+        yield context.restore(item, reset=scoped)
+
+
+_whitespace = re.compile(r'[ \t\n\r]*')
+
+
+def _array_items(source, blocksize=65536, raw_decode=None):
+    """Generate the decoded elements of the top-level JSON array in source
+
+    The elements are decoded with raw_decode(string, pos), by default the
+    one of the standard json module.
+
+    >>> list(_array_items(' [ 12 , [3], "]" ] ')) == [12, [3], ']']
+    True
+    >>> list(_array_items('[]'))
+    []
+
+    """
+    if raw_decode is None:
+        raw_decode = json.JSONDecoder().raw_decode
+    read = getattr(source, 'read', None)
+    if read is None:
+        buf, eof = source, True
+    else:
+        buf, eof = '', False
+    pos = 0
+    ## 0: before "[", 1: before the first element or "]",
+    ## 2: after an element, 3: after ","
+    state = 0
+    while True:
+        pos = _whitespace.match(buf, pos).end()
+        if pos == len(buf):
+            if eof:
+                raise ValueError('Unterminated JSON array')
+            buf, pos, eof = _read_more(read, buf, pos, blocksize)
+            continue
+        char = buf[pos]
+        if state == 0:
+            if char != '[':
+                raise ValueError('Expecting a JSON array at %d' % pos)
+            pos += 1
+            state = 1
+            continue
+        if state == 2:
+            if char == ',':
+                pos += 1
+                state = 3
+                continue
+            if char == ']':
+                return
+            raise ValueError('Expecting , or ] at %d' % pos)
+        if state == 1 and char == ']':
+            return
+        try:
+            value, end = raw_decode(buf, pos)
+        except ValueError:
+            if eof:
+                raise
+            end = None
+        # A value cut by the end of the buffer may still parse (e.g. "2."
+        # gives 2), it is complete once the "," or "]" after it is read
+        if end is not None and not eof:
+            after = _whitespace.match(buf, end).end()
+            if after == len(buf) or buf[after] not in ',]':
+                end = None
+        if end is None:
+            buf, pos, eof = _read_more(read, buf, pos, blocksize)
+            continue
+        yield value
+        pos = end
+        state = 2
+
+
+def _read_more(read, buf, pos, blocksize):
+    """Drop the consumed part of buf and append the next block (at least
+    as large as what is left, so that a long element is not parsed again
+    for every block)"""
+    buf = buf[pos:]
+    data = read(max(blocksize, len(buf)))
+    return buf + data, 0, not data
+
+
 def _make_backend(backend):
     if backend is None:
-        return JSONBackend()
+        return jsonpickle.backend.json
     else:
         return backend
 
@@ -37,12 +169,17 @@ def _supports_getstate(obj, instance):
 
 class Unpickler(object):
 
-    def __init__(self, backend=None, keys=False, safe=False):
+    def __init__(self, backend=None, keys=False, safe=False,
+                 legacy_refs=True):
         ## The current recursion depth
         ## Maps reference names to object instances
         self.backend = _make_backend(backend)
         self.keys = keys
         self.safe = safe
+        ## Track the JSON path of each object for old "py/ref" references.
+        ## Documents written by this version only use "py/id", so this
+        ## bookkeeping can be turned off to decode them faster.
+        self.legacy_refs = legacy_refs
 
         self._namedict = {}
         ## The namestack grows whenever we recurse into a child object
@@ -76,27 +213,132 @@ class Unpickler(object):
         return self._restore(obj)
 
     def _restore(self, obj):
-        if has_tag(obj, tags.ID):
-            restore = self._restore_id
-        elif has_tag(obj, tags.REF): # Backwards compatibility
-            restore = self._restore_ref
-        elif has_tag(obj, tags.TYPE):
-            restore = self._restore_type
-        elif has_tag(obj, tags.REPR): # Backwards compatibility
-            restore = self._restore_repr
-        elif has_tag(obj, tags.OBJECT):
-            restore = self._restore_object
-        elif util.is_list(obj):
-            restore = self._restore_list
-        elif has_tag(obj, tags.TUPLE):
-            restore = self._restore_tuple
-        elif has_tag(obj, tags.SET):
-            restore = self._restore_set
-        elif util.is_dictionary(obj):
-            restore = self._restore_dict
-        else:
-            restore = lambda x: x
-        return restore(obj)
+        """Restore obj
+
+        Lists, dicts, tuples and sets are walked with an explicit stack of
+        frames instead of recursive calls, so deeply nested containers do
+        not grow the Python stack.  Each frame is [items iterator, output
+        list or dict, True if the items are key/value pairs, key of the
+        item being restored, how to finish the output (None to use it as
+        is, the list to extend, or tuple or set)].
+
+        >>> u = Unpickler()
+        >>> u.restore([1, {'py/tuple': [2, [3]]}, {'py/id': 0}])
+        [1, (2, [3]), [...]]
+        >>> deep = []
+        >>> for i in range(5000):
+        ...     deep = [deep]
+        >>> value = u.restore(deep)
+        >>> for i in range(5000):
+        ...     value = value[0]
+        >>> value
+        []
+        """
+        value, frame = self._restore_enter(obj)
+        if frame is None:
+            return value
+        legacy_refs = self.legacy_refs
+        keys = self.keys
+        stack = [frame]
+        while True:
+            frame = stack[-1]
+            items, data = frame[0], frame[1]
+            child = None
+            if frame[2]:
+                for k, v in items:
+                    cls = type(v)
+                    container = cls is dict or cls is list
+                    # The path only matters to the references made below
+                    named = legacy_refs and (container or keys)
+                    if named:
+                        self._namestack.append(k)
+                    if keys and k.startswith(tags.JSON_KEY):
+                        k = decode(k[len(tags.JSON_KEY):],
+                                   backend=self.backend, context=self,
+                                   keys=True, reset=False)
+                    if container:
+                        value, child = self._restore_enter(v)
+                        if child is not None:
+                            # step into the child, resumed after it
+                            frame[3] = k
+                            break
+                        data[k] = value
+                    else:
+                        # primitives restore to themselves
+                        data[k] = v
+                    if named:
+                        self._namestack.pop()
+            else:
+                for v in items:
+                    cls = type(v)
+                    if cls is dict or cls is list:
+                        value, child = self._restore_enter(v)
+                        if child is not None:
+                            break
+                        data.append(value)
+                    else:
+                        data.append(v)
+            if child is not None:
+                stack.append(child)
+                continue
+            # all items done, hand the result to the parent frame
+            stack.pop()
+            value = _restore_finish(frame[4], data)
+            if not stack:
+                return value
+            parent = stack[-1]
+            if parent[2]:
+                parent[1][parent[3]] = value
+                if legacy_refs:
+                    self._namestack.pop()
+            else:
+                parent[1].append(value)
+
+    def _restore_enter(self, obj):
+        """Start restoring obj
+
+        Return (value, None) when obj is done or (None, frame) when obj is
+        a container whose items remain to be restored.
+        """
+        cls = type(obj)
+        if cls is dict:
+            # One pass over the keys finds the tags, the highest
+            # priority one selects the restore method
+            found = _restore_tags.intersection(obj)
+            if not found:
+                items = sorted(obj.items(), key=util.itemgetter)
+                # Fast path: primitive values restore to themselves and
+                # need no path, only non-string keys need decoding
+                if (util.is_primitive_sequence(obj.values()) and
+                        not (self.keys and _has_json_key(obj))):
+                    return dict(items), None
+                return None, [iter(items), {}, True, None, None]
+            if len(found) == 1:
+                tag = found.pop()
+            else:
+                tag = min(found, key=_restore_priority.get)
+            restore = _restore_table[tag]
+            if restore is not None:
+                return restore(self, obj), None
+            # py/tuple or py/set
+            finish = _restore_sequences[tag]
+            items = obj[tag]
+            # Fast path: primitives restore to themselves
+            if util.is_primitive_sequence(items):
+                return finish(items), None
+            return None, [iter(items), [], False, None, finish]
+        if cls is list:
+            # Same as _mkref(), a new list cannot be registered yet
+            parent = []
+            self._obj_to_idx[id(parent)] = len(self._objs)
+            self._objs.append(parent)
+            if self.legacy_refs:
+                self._namedict[self._refname()] = parent
+            if util.is_primitive_sequence(obj):
+                parent.extend(obj)
+                return parent, None
+            return None, [iter(obj), [], False, None, parent]
+        return obj, None
 
     def _restore_id(self, obj):
         return self._objs[obj[tags.ID]]
@@ -155,11 +397,13 @@ class Unpickler(object):
         return self._restore_object_instance_variables(obj, instance)
 
     def _restore_object_instance_variables(self, obj, instance):
+        legacy_refs = self.legacy_refs
         for k, v in sorted(obj.items(), key=util.itemgetter):
             # ignore the reserved attribute
             if k in tags.RESERVED:
                 continue
-            self._namestack.append(k)
+            if legacy_refs:
+                self._namestack.append(k)
             # step into the namespace
             value = self._restore(v)
             if (util.is_noncomplex(instance) or
@@ -168,7 +412,8 @@ class Unpickler(object):
             else:
                 setattr(instance, k, value)
             # step out
-            self._namestack.pop()
+            if legacy_refs:
+                self._namestack.pop()
 
         # Handle list and set subclasses
         if has_tag(obj, tags.SEQ):
@@ -189,31 +434,6 @@ class Unpickler(object):
         instance.__setstate__(state)
         return instance
 
-    def _restore_list(self, obj):
-        parent = []
-        self._mkref(parent)
-        children = [self._restore(v) for v in obj]
-        parent.extend(children)
-        return parent
-
-    def _restore_tuple(self, obj):
-        return tuple([self._restore(v) for v in obj[tags.TUPLE]])
-
-    def _restore_set(self, obj):
-        return set([self._restore(v) for v in obj[tags.SET]])
-
-    def _restore_dict(self, obj):
-        data = {}
-        for k, v in sorted(obj.items(), key=util.itemgetter):
-            self._namestack.append(k)
-            if self.keys and k.startswith(tags.JSON_KEY):
-                k = decode(k[len(tags.JSON_KEY):],
-                           backend=self.backend, context=self,
-                           keys=True, reset=False)
-            data[k] = self._restore(v)
-            self._namestack.pop()
-        return data
-
     def _refname(self):
         """Calculates the name of the current location in the JSON stack.
 
@@ -260,10 +480,113 @@ class Unpickler(object):
             self._objs.append(obj)
             # Backwards compatibility: old versions of jsonpickle
             # produced "py/ref" references.
-            self._namedict[self._refname()] = obj
+            if self.legacy_refs:
+                self._namedict[self._refname()] = obj
         return obj
 
 
+# Restore method of each tag, in priority order when a dict holds several
+# (None for the sequences, walked by Unpickler._restore() itself)
+_restore_order = (
+    (tags.ID, Unpickler._restore_id),
+    (tags.REF, Unpickler._restore_ref), # Backwards compatibility
+    (tags.TYPE, Unpickler._restore_type),
+    (tags.REPR, Unpickler._restore_repr), # Backwards compatibility
+    (tags.OBJECT, Unpickler._restore_object),
+    (tags.TUPLE, None),
+    (tags.SET, None),
+)
+_restore_table = dict(_restore_order)
+_restore_priority = dict((tag, i) for i, (tag, method) in enumerate(_restore_order))
+_restore_tags = set(_restore_table)
+_restore_sequences = {tags.TUPLE: tuple, tags.SET: set}
+
+
+def _has_json_key(obj):
+    for k in obj:
+        if k.startswith(tags.JSON_KEY):
+            return True
+    return False
+
+
+def _restore_finish(finish, items):
+    """Build the restored container from its restored items"""
+    if finish is None:
+        return items
+    if type(finish) is list:
+        finish.extend(items)
+        return finish
+    return finish(items)
+
+
+class _ClassCache(object):
+    """Bounded, thread-safe cache of the classes resolved by loadclass()
+
+    Entries map a "module.name" string to the module name, the attribute
+    name and the class found (None when the lookup failed).  A hit is
+    checked against sys.modules before being returned, so a reloaded or
+    monkey-patched module is looked up again, and a failed lookup is
+    retried once its module has been imported.  Only classes found by
+    import are stored, never objects evaluated from a "py/repr", so the
+    cache does not change what safe mode allows.
+
+    >>> cache = _ClassCache(maxsize=2)
+    >>> cache.load('jsonpickle._samples.Thing')
+    <class 'jsonpickle._samples.Thing'>
+    >>> len(cache)
+    1
+    >>> cache.load('does.not.exist')
+    >>> cache.load('does.not.exist')
+    >>> len(cache)
+    2
+    >>> cache.load('__builtin__.int')()
+    0
+    >>> len(cache)
+    1
+
+    """
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def load(self, module_and_name):
+        entry = self._entries.get(module_and_name)
+        if entry is not None:
+            module, name, cls = entry
+            mod = sys.modules.get(module)
+            if mod is None:
+                if cls is None:
+                    return None
+            elif getattr(mod, name, None) is cls:
+                return cls
+        try:
+            module, name = module_and_name.rsplit('.', 1)
+            module = util.untranslate_module_name(module)
+        except:
+            return None
+        try:
+            __import__(module)
+            cls = getattr(sys.modules[module], name)
+        except:
+            cls = None
+        with self._lock:
+            # Like the re module, start over rather than track usage
+            if len(self._entries) >= self.maxsize:
+                self._entries.clear()
+            self._entries[module_and_name] = (module, name, cls)
+        return cls
+
+_class_cache = _ClassCache()
+
+
 def loadclass(module_and_name):
     """Loads the module and returns the class.
 
@@ -277,13 +600,7 @@ def loadclass(module_and_name):
     0
 
     """
-    try:
-        module, name = module_and_name.rsplit('.', 1)
-        module = util.untranslate_module_name(module)
-        __import__(module)
-        return getattr(sys.modules[module], name)
-    except:
-        return None
+    return _class_cache.load(module_and_name)
 
 
 def loadfactory(obj):
@@ -24,6 +24,7 @@ from jsonpickle.compat import PY3
 SEQUENCES = (list, set, tuple)
 SEQUENCES_SET = set(SEQUENCES)
 PRIMITIVES = set((str, unicode, bool, float, int, long))
+PRIMITIVES_AND_NONE = PRIMITIVES | set((type(None),))
 
 
 def is_type(obj):
@@ -78,6 +79,22 @@ def is_primitive(obj):
         return True
     return False
 
+
+def is_primitive_sequence(obj):
+    """Helper method to see if all the items of a sequence are primitive.
+    The item types are collected at C speed, which makes this much cheaper
+    than testing each item with *is_primitive()*
+
+    >>> is_primitive_sequence([1, 2.5, 'x', None, True])
+    True
+    >>> is_primitive_sequence([1, [2]])
+    False
+    >>> is_primitive_sequence(())
+    True
+    """
+    return set(map(type, obj)) <= PRIMITIVES_AND_NONE
+
+
 def is_dictionary(obj):
     """Helper method for testing if the object is a dictionary.
 
@@ -7,8 +7,8 @@
 # The contents of this file are distributed under the CC0 license.
 # See http://creativecommons.org/publicdomain/zero/1.0/
 # ----------------------------------------------------------------
-import hid
 import time
+import math
 import os
 import sys
 import traceback
@@ -17,22 +17,33 @@ from pytz import timezone
 from optparse import OptionParser
 import threading
 import ConfigParser
-import jsonpickle
-import copy
-
-dbSupport = False
+from radangel_sinks import createSinks, dbSupport, bucketIntervals
+from radangel_state import CaptureCheckpoint
+from radangel_live import LiveHistogramWriter, defaultLiveFilename
+from radangel_hidraw import HidrawDevice, HIDRawDeviceList
+from radangel_control import ControlServer
+from radangel_rate import RateRingBuffer, RateLog
+from radangel_background import BackgroundModel
+from radangel_isotope import IsotopeLibrary, numpySupport as isotopeSupport
+
+# hidapi is only needed for capture (export and query tools import this module too)
+hidSupport = False
 try:
-    from pymongo import MongoClient, errors
-    dbSupport = True
+    import hid
+    hidSupport = True
 except:
-    print "No MongoDB support"
     pass
 
+if not dbSupport:
+    print "No MongoDB support"
+
 zulu_fmt = "%Y-%m-%dT%H:%M:%SZ"
 
 # Global definitions
 COUNTRATE_INTERVAL = 1.0
 PASSCOUNTS_INTERVAL = 0.1
+DEVICE_RESCAN_INTERVAL = 1.0
+SINK_POLL_INTERVAL = 1.0
 USB_VENDOR_ID = 0x04d8
 USB_PRODUCT_ID = 0x100
 
@@ -100,6 +111,97 @@ class RadAngelConfiguration():
         self.db_passwd = config.get('radangel', 'db_passwd')
         self.loggingInterval = config.getfloat('radangel', 'logging_interval')
         self.networkTimeout = config.getint('radangel', 'network_timeout')
+
+        # Capture state checkpoint period in seconds (0 = disabled)
+        self.checkpointInterval = 5.0
+        if config.has_option('radangel', 'checkpoint_interval'):
+          self.checkpointInterval = config.getfloat('radangel', 'checkpoint_interval')
+
+        # Live histogram segment (file name may contain %s for the device id)
+        self.liveFilename = None
+        self.liveInterval = 1.0
+        if config.has_option('radangel', 'live_file'):
+          self.liveFilename = config.get('radangel', 'live_file')
+        if config.has_option('radangel', 'live_interval'):
+          self.liveInterval = config.getfloat('radangel', 'live_interval')
+
+        # Database time buckets in seconds (0 = one document per interval)
+        self.bucketSize = 0
+        if config.has_option('radangel', 'db_bucket_size'):
+          self.bucketSize = config.getint('radangel', 'db_bucket_size')
+
+        # Optional local sinks
+        self.sqliteFilename = None
+        self.sqliteBatch = 16
+        self.recordsFilename = None
+        if config.has_option('radangel', 'sqlite_file'):
+          self.sqliteFilename = config.get('radangel', 'sqlite_file')
+        if config.has_option('radangel', 'sqlite_batch'):
+          self.sqliteBatch = config.getint('radangel', 'sqlite_batch')
+        if config.has_option('radangel', 'records_file'):
+          self.recordsFilename = config.get('radangel', 'records_file')
+
+        # Optional aggregator daemon (unix:/path or host:port)
+        self.aggregatorAddress = None
+        self.aggregatorBatch = 1
+        if config.has_option('radangel', 'aggregator'):
+          self.aggregatorAddress = config.get('radangel', 'aggregator')
+        if config.has_option('radangel', 'aggregator_batch'):
+          self.aggregatorBatch = config.getint('radangel', 'aggregator_batch')
+
+        # Control socket (file name may contain %s for the device id, default next to the log file)
+        self.controlSocket = None
+        if config.has_option('radangel', 'control_socket'):
+          self.controlSocket = config.get('radangel', 'control_socket')
+
+        # Adaptive logging interval (logging_interval is then the maximum duration)
+        self.adaptiveCounts = 0
+        self.adaptiveSigma = 0.0
+        self.adaptiveMinInterval = 10.0
+        if config.has_option('radangel', 'adaptive_counts'):
+          self.adaptiveCounts = config.getint('radangel', 'adaptive_counts')
+        if config.has_option('radangel', 'adaptive_sigma'):
+          self.adaptiveSigma = config.getfloat('radangel', 'adaptive_sigma')
+        if config.has_option('radangel', 'adaptive_min_interval'):
+          self.adaptiveMinInterval = config.getfloat('radangel', 'adaptive_min_interval')
+
+        # The intervals of a database bucket must fit in one MongoDB document
+        if self.bucketSize > 0:
+          minInterval = self.loggingInterval
+          if self.adaptiveCounts > 0 or self.adaptiveSigma > 0:
+            minInterval = min(minInterval, self.adaptiveMinInterval)
+          if bucketIntervals(self.bucketSize, max(minInterval, 0.001)) == None:
+            print "Warning: db_bucket_size %d is too large for %0.3f second intervals, the intervals which do not fit in a bucket go to the spectrum collection" % (self.bucketSize, minInterval)
+
+        # Count rate history in seconds (0 = disabled) and optional rate log (file name may contain %s)
+        self.rateBuffer = 3600.0
+        self.rateLogFilename = None
+        self.rateLogPeriod = 1.0
+        if config.has_option('radangel', 'rate_buffer'):
+          self.rateBuffer = config.getfloat('radangel', 'rate_buffer')
+        if config.has_option('radangel', 'rate_log_file'):
+          self.rateLogFilename = config.get('radangel', 'rate_log_file')
+        if config.has_option('radangel', 'rate_log_period'):
+          self.rateLogPeriod = config.getfloat('radangel', 'rate_log_period')
+
+        # Running background spectrum (EWMA weight, 0 = disabled) and alarm threshold in sigma (0 = no exclusion)
+        self.backgroundAlpha = 0.0
+        self.backgroundAlarmSigma = 0.0
+        if config.has_option('radangel', 'background_alpha'):
+          self.backgroundAlpha = config.getfloat('radangel', 'background_alpha')
+        if config.has_option('radangel', 'background_alarm_sigma'):
+          self.backgroundAlarmSigma = config.getfloat('radangel', 'background_alarm_sigma')
+
+        # Isotope identification templates directory, spectrum to fit (interval or cumulative) and threshold in sigma
+        self.isotopeLibrary = None
+        self.isotopeSpectrum = "interval"
+        self.isotopeSigma = 3.0
+        if config.has_option('radangel', 'isotope_library'):
+          self.isotopeLibrary = config.get('radangel', 'isotope_library')
+        if config.has_option('radangel', 'isotope_spectrum'):
+          self.isotopeSpectrum = config.get('radangel', 'isotope_spectrum')
+        if config.has_option('radangel', 'isotope_sigma'):
+          self.isotopeSigma = config.getfloat('radangel', 'isotope_sigma')
       else:
         print "Configuration file is missing"
         sys.exit(0)
@@ -109,6 +211,80 @@ class RadAngelConfiguration():
         for path, serial in config.items("device"):
             self.devices[path.replace("_",":").lower()] = serial
 
+#
+# Adaptive logging interval
+#
+# An interval is closed once adaptive_counts events are accumulated or when its
+# count rate differs from the previous interval rate by adaptive_sigma standard
+# deviations, but never before adaptive_min_interval nor after logging_interval
+# seconds. The rate test compares both Poisson rates under the hypothesis of a
+# common rate, so a short interval with few counts is not taken for a change.
+#
+# The rate test is only run once per adaptive_min_interval of the interval, and
+# since every look is a new chance of a false alarm, its threshold is raised for
+# the number of looks in a logging_interval (Bonferroni correction), so that
+# adaptive_sigma is the false alarm level of a whole interval.
+#
+class AdaptiveInterval():
+    def __init__(self, maxCounts, sigma, minInterval):
+        self.maxCounts = maxCounts
+        self.sigma = sigma
+        self.minInterval = minInterval
+        self.lookPeriod = max(minInterval, PASSCOUNTS_INTERVAL)
+        self.nextLook = self.lookPeriod
+        self.thresholds = {} # number of looks -> corrected sigma
+        self.referenceCounts = 0
+        self.referenceLivetime = 0.0
+        self.reason = None
+
+    def threshold(self, maxInterval):
+        """Rate test threshold in sigma for the looks of a maxInterval seconds interval"""
+        looks = max(1, int(maxInterval / self.lookPeriod))
+        if looks not in self.thresholds:
+            # Two-sided tail probability divided by the looks, back to sigma by bisection
+            probability = math.erfc(self.sigma / math.sqrt(2.0)) / looks
+            low, high = self.sigma, self.sigma + 40.0
+            for i in range(60):
+                middle = (low + high) / 2.0
+                if math.erfc(middle / math.sqrt(2.0)) > probability:
+                    low = middle
+                else:
+                    high = middle
+            self.thresholds[looks] = high
+        return self.thresholds[looks]
+
+    def rateChange(self, counts, livetime):
+        """Significance in sigma of the rate change since the previous interval"""
+        if self.referenceLivetime <= 0 or livetime <= 0:
+            return 0.0
+        pooledRate = float(counts + self.referenceCounts) / (livetime + self.referenceLivetime)
+        if pooledRate <= 0:
+            return 0.0
+        difference = float(counts) / livetime - float(self.referenceCounts) / self.referenceLivetime
+        return abs(difference) / math.sqrt(pooledRate * (1.0 / livetime + 1.0 / self.referenceLivetime))
+
+    def expired(self, elapsed, maxInterval, counts, livetime):
+        if elapsed >= maxInterval:
+            self.reason = "time"
+        elif elapsed < self.minInterval:
+            return False
+        elif self.maxCounts > 0 and counts >= self.maxCounts:
+            self.reason = "counts"
+        elif self.sigma > 0 and elapsed >= self.nextLook:
+            while self.nextLook <= elapsed:
+                self.nextLook += self.lookPeriod
+            if self.rateChange(counts, livetime) < self.threshold(maxInterval):
+                return False
+            self.reason = "rate"
+        else:
+            return False
+        return True
+
+    def closed(self, counts, livetime):
+        self.referenceCounts = counts
+        self.referenceLivetime = livetime
+        self.nextLook = self.lookPeriod
+
 #
 # RadAngel processing class
 #
@@ -124,8 +300,22 @@ class RadAngel():
             self.Terminated = False
         def run(self):
             while not self.Terminated:
-                d = self.hidDevice.read(62, timeout_ms = 50)
-                if d:
+                # Native backends return all the pending reports at once
+                readReports = getattr(self.hidDevice, "readReports", None)
+                try:
+                    if readReports != None:
+                        reports = readReports(62, timeout_ms = 50)
+                    else:
+                        d = self.hidDevice.read(62, timeout_ms = 50)
+                        reports = [d] if d else []
+                except:
+                    # Unplugged or USB bus reset, wait for the device to come back
+                    self.hidDevice = self.radAngelInstance.reattachDevice(self.hidDevice, self)
+                    continue
+                if self.radAngelInstance.paused:
+                    # Keep draining the device but drop the events
+                    continue
+                for d in reports:
                     #print d
                     self.radAngelInstance.ratecounter += 1
                     self.radAngelInstance.totalcounter += 1
@@ -139,7 +329,11 @@ class RadAngel():
         def stop(self):
             self.Terminated = True
 
-    def __init__(self, config, deviceId, devicePath, logFilename, useDatabase, captureTime, captureCount):
+    # Device paths opened by the running RadAngel instances
+    devicePathsInUse = set()
+    devicePathsLock = threading.Lock()
+
+    def __init__(self, config, deviceId, devicePath, logFilename, useDatabase, captureTime, captureCount, resume = True, hidraw = False):
         self.config = config
         self.deviceId = deviceId
         self.devicePath = devicePath
@@ -147,10 +341,88 @@ class RadAngel():
         self.useDatabase = useDatabase
         self.captureTime = captureTime
         self.captureCount = captureCount
+        self.resume = resume
+        self.hidraw = hidraw
+        self.checkpointFilename = os.path.splitext(logFilename)[0]+".state"
+        self.loggingInterval = config.loggingInterval
+        self.deviceAttached = False
+        self.paused = False
+        self.Terminated = False
 
     def logPrint(self, message):
        print "[%s] %s" % (self.deviceId, message)
 
+    def stop(self):
+        self.Terminated = True
+
+    #
+    # Device handling
+    #
+    def deviceList(self):
+        if self.hidraw:
+            usbPathList = HIDRawDeviceList(USB_VENDOR_ID, USB_PRODUCT_ID)
+        else:
+            usbPathList = HIDDeviceList()
+        return [path.replace("_",":").lower() for path in usbPathList]
+
+    def openDevice(self, devicePath, anyDevice = False):
+        self.logPrint("Opening device id %s [%s]" % (self.deviceId, devicePath))
+        if self.hidraw:
+            hidDevice = HidrawDevice(USB_VENDOR_ID, USB_PRODUCT_ID)
+        else:
+            hidDevice = hid.device()
+        try:
+          hidDevice.open_path(devicePath)
+        except:
+          if not anyDevice:
+              raise
+          hidDevice.open(USB_VENDOR_ID, USB_PRODUCT_ID)
+
+        self.logPrint("Manufacturer: %s" % hidDevice.get_manufacturer_string())
+        self.logPrint("Product: %s" % hidDevice.get_product_string())
+
+        with RadAngel.devicePathsLock:
+            RadAngel.devicePathsInUse.add(devicePath)
+        self.devicePath = devicePath
+        self.deviceAttached = True
+        return hidDevice
+
+    def closeDevice(self, hidDevice):
+        self.deviceAttached = False
+        with RadAngel.devicePathsLock:
+            RadAngel.devicePathsInUse.discard(self.devicePath)
+        try:
+          hidDevice.close()
+        except:
+          pass
+
+    def reattachDevice(self, hidDevice, usbRead):
+        """Close the lost device and poll until it (or a free RadAngel) is plugged again"""
+        lost_time = time.time()
+        self.logPrint("Device %s lost, waiting for it to be plugged again" % self.devicePath)
+        print '-'*60
+        traceback.print_exc(file=sys.stdout)
+        print '-'*60
+        self.closeDevice(hidDevice)
+
+        while not usbRead.Terminated:
+            time.sleep(DEVICE_RESCAN_INTERVAL)
+            usbPathList = self.deviceList()
+            with RadAngel.devicePathsLock:
+                # The same path first, otherwise a free device which is not assigned to another id
+                # (the USB device number changes when the detector is plugged again)
+                candidates = [path for path in usbPathList if path == self.devicePath]
+                candidates += [path for path in usbPathList if path not in RadAngel.devicePathsInUse and
+                               self.config.devices.get(path, self.deviceId) == self.deviceId and path != self.devicePath]
+            for path in candidates:
+                try:
+                  hidDevice = self.openDevice(path)
+                  self.logPrint("Device re-attached after %0.3f seconds" % (time.time() - lost_time))
+                  return hidDevice
+                except:
+                  pass
+        return hidDevice
+
     #
     # Kromek RAW data processing
     #
@@ -159,57 +431,142 @@ class RadAngel():
         usbRead = None
         logfile = None
         hidDevice = None
+        live = None
+        control = None
+        snapshotRequests = []
+        adaptive = None
+        rate = None
+        rateLog = None
+        background = None
+        isotopes = None
 
         countrate = 0.0 # CPS
         livetime = 0.0
         realtime = 0.0
         previousRealtime = 0.0
         previousLivetime = 0.0
+        disconnected = 0.0 # time without device
+        previousDisconnected = 0.0
 
         # Initialize counters
         self.counts = {}
         self.ratecounter = 0
         self.totalcounter = 0 # keep track of total counts since start
         channelsTotal = [0 for i in range (4096)]
-
-        # Cached data
-        try:
-          cachedData = jsonpickle.decode(open("cached_%s.json" % self.deviceId,'r').read())
-          os.remove("cached_%s.json" % self.deviceId)
-        except:
-          cachedData = []
-
-        if self.useDatabase:
+        intervalSequence = 0
+        intervalElapsed = 0.0
+        captureCompleted = False
+
+        # Resume from the last checkpoint
+        checkpoint = None
+        if self.config.checkpointInterval > 0:
+            checkpoint = CaptureCheckpoint(self.checkpointFilename)
+            checkpoint.open()
+            state = None
+            if self.resume:
+                state = checkpoint.load(self.deviceId)
+            else:
+                # Do not leave the previous capture state to a later resume
+                checkpoint.reset()
+            if state != None:
+                self.logPrint("Resuming from %s (realtime = %0.3f, total count = %d)" % (self.checkpointFilename, state.realtime, state.totalcounter))
+                self.counts = state.counts
+                self.totalcounter = state.totalcounter
+                channelsTotal = state.channelsTotal
+                intervalSequence = state.intervalSequence
+                intervalElapsed = state.intervalElapsed
+                realtime = state.realtime
+                livetime = state.livetime
+                previousRealtime = state.previousRealtime
+                previousLivetime = state.previousLivetime
+        intervalStartCounter = self.totalcounter - sum(self.counts.values())
+
+        if self.config.adaptiveCounts > 0 or self.config.adaptiveSigma > 0:
+            self.logPrint("Adaptive logging interval (%d counts, %0.1f sigma, %0.3f to %0.3f seconds)" % (self.config.adaptiveCounts,
+                          self.config.adaptiveSigma, self.config.adaptiveMinInterval, self.loggingInterval))
+            adaptive = AdaptiveInterval(self.config.adaptiveCounts, self.config.adaptiveSigma, self.config.adaptiveMinInterval)
+
+        # Storage sinks
+        sinks = createSinks(self.config, self.deviceId, self.useDatabase)
+        for sink in sinks:
             try:
-              connection = MongoClient(self.config.db_host, self.config.db_port, socketTimeoutMS=self.config.networkTimeout, connectTimeoutMS=self.config.networkTimeout)
-              db = connection[self.config.db_name]
-              # MongoLab has user authentication
-              db.authenticate(self.config.db_user, self.config.db_passwd)
+              sink.open()
             except:
               print '-'*60
               traceback.print_exc(file=sys.stdout)
               print '-'*60
               sys.exit(1)
 
-        try:
-            self.logPrint("Opening device id %s [%s]" % (self.deviceId, self.devicePath))
-            hidDevice = hid.device()
-            try:
-              hidDevice.open_path(self.devicePath)
-            except:
-              hidDevice.open(USB_VENDOR_ID, USB_PRODUCT_ID)
+        # Background model
+        if self.config.backgroundAlpha > 0:
+            background = BackgroundModel(self.deviceId, self.config.backgroundAlpha, self.config.backgroundAlarmSigma)
+            background.open()
+
+        # Isotope identification
+        if self.config.isotopeLibrary != None:
+            if not isotopeSupport:
+                self.logPrint("No numpy support, isotope identification disabled")
+            else:
+                try:
+                  isotopes = IsotopeLibrary(self.config.isotopeLibrary)
+                  isotopes.load()
+                  self.logPrint("Isotope templates: %s" % ", ".join(isotopes.names))
+                except:
+                  self.logPrint("Failed to load isotope templates from %s" % self.config.isotopeLibrary)
+                  print '-'*60
+                  traceback.print_exc(file=sys.stdout)
+                  print '-'*60
+                  isotopes = None
 
-            self.logPrint("Manufacturer: %s" % hidDevice.get_manufacturer_string())
-            self.logPrint("Product: %s" % hidDevice.get_product_string())
+        try:
+            hidDevice = self.openDevice(self.devicePath, anyDevice = True)
 
             # Open log file
             self.logPrint("Appending data to %s ..." % self.logFilename)
             logfile = open(self.logFilename, "a", 1)
 
+            # Publish the live histogram
+            if self.config.liveFilename == None:
+                liveFilename = defaultLiveFilename(self.deviceId)
+            else:
+                liveFilename = self.config.liveFilename.replace("%s", self.deviceId)
+            if liveFilename and self.config.liveInterval > 0:
+                self.logPrint("Publishing live histogram to %s" % liveFilename)
+                live = LiveHistogramWriter(liveFilename, self.deviceId)
+                live.open()
+
+            # Listen for control commands
+            if self.config.controlSocket == None:
+                controlFilename = os.path.splitext(self.logFilename)[0]+".sock"
+            else:
+                controlFilename = self.config.controlSocket.replace("%s", self.deviceId)
+            if controlFilename:
+                try:
+                  control = ControlServer(controlFilename)
+                  control.start()
+                  self.logPrint("Control socket on %s" % controlFilename)
+                except:
+                  self.logPrint("Failed to create control socket %s" % controlFilename)
+                  control = None
+
+            # Count rate history
+            if self.config.rateBuffer > 0:
+                rate = RateRingBuffer(int(self.config.rateBuffer / PASSCOUNTS_INTERVAL))
+            if self.config.rateLogFilename != None:
+                rateLog = RateLog(self.config.rateLogFilename.replace("%s", self.deviceId), self.config.rateLogPeriod)
+                rateLog.open()
+                self.logPrint("Appending count rate to %s ..." % rateLog.filename)
+            tickCounter = self.totalcounter
+            tickLivetime = livetime
+
             # Start timers
             start_time = time.time()
             countrate_start_time = start_time # countrate computation
             passcount_start_time = start_time # realtime, livetime computation
+            checkpoint_start_time = start_time # capture state checkpoint
+            live_start_time = start_time # live histogram
+            sink_poll_start_time = start_time # delayed sink writes
+            start_time = start_time - intervalElapsed # resumed logging interval
 
             # Start USB reading thread
             self.logPrint("Start USB reading thread")
@@ -228,14 +585,89 @@ class RadAngel():
                 if (passcount_elapsed_time >= PASSCOUNTS_INTERVAL):
                     passcount_start_time = time.time()
 
-                    currentRealtime = realtime;
-                    elapsed_time = time.time() - start_time
-                    realtime = realtime + passcount_elapsed_time;
-                    elapased = realtime - currentRealtime;
-                    livetime = livetime + elapased * (1.0 - countrate * 1E-05);
+                    if self.deviceAttached and not self.paused:
+                        currentRealtime = realtime;
+                        elapsed_time = time.time() - start_time
+                        realtime = realtime + passcount_elapsed_time;
+                        elapased = realtime - currentRealtime;
+                        livetime = livetime + elapased * (1.0 - countrate * 1E-05);
+                    elif not self.deviceAttached:
+                        # Not acquiring, keep track of the time lost
+                        disconnected = disconnected + passcount_elapsed_time;
+
+                    # Count rate tick
+                    currentCounter = self.totalcounter
+                    if rate != None:
+                        rate.append(passcount_start_time, currentCounter - tickCounter, livetime - tickLivetime)
+                    if rateLog != None:
+                        rateLog.append(passcount_start_time, currentCounter - tickCounter, livetime - tickLivetime)
+                    tickCounter = currentCounter
+                    tickLivetime = livetime
+
+                # Control commands, answered between two passes of the main loop
+                if control != None:
+                    for request in control.pending():
+                        try:
+                          if request.command == "snapshot":
+                              # Replied once the interval is logged
+                              snapshotRequests.append(request)
+                          elif request.command == "spe":
+                              if request.args:
+                                  speFilename = request.args[0]
+                              else:
+                                  speFilename = "%s_%s.spe" % (os.path.splitext(self.logFilename)[0], datetime.now(timezone('UTC')).strftime("%Y%m%dT%H%M%SZ"))
+                              counts = dict(self.counts)
+                              export2SPE(speFilename, self.deviceId, [x + counts.get(i, 0) for i, x in enumerate(channelsTotal)], realtime, livetime)
+                              request.reply({"status": "ok", "filename": speFilename})
+                          elif request.command == "rotate":
+                              rotatedFilename = "%s.%s" % (self.logFilename, datetime.now(timezone('UTC')).strftime("%Y%m%dT%H%M%SZ"))
+                              try:
+                                os.rename(self.logFilename, rotatedFilename)
+                              finally:
+                                # The open handle follows the renamed file, always reopen the
+                                # log so the capture keeps a valid one even if the rename failed
+                                logfile.close()
+                                logfile = open(self.logFilename, "a", 1)
+                              self.logPrint("Log file rotated to %s" % rotatedFilename)
+                              request.reply({"status": "ok", "filename": rotatedFilename})
+                          elif request.command == "interval":
+                              if not request.args:
+                                  raise ValueError("Missing logging interval")
+                              loggingInterval = float(request.args[0])
+                              if loggingInterval <= 0:
+                                  raise ValueError("Logging interval must be positive")
+                              self.loggingInterval = loggingInterval
+                              self.logPrint("Logging interval set to %0.3f seconds" % loggingInterval)
+                              request.reply({"status": "ok", "interval": loggingInterval})
+                          elif request.command in ("pause", "resume"):
+                              self.paused = (request.command == "pause")
+                              self.logPrint("Acquisition %s" % ("paused" if self.paused else "resumed"))
+                              request.reply({"status": "ok", "paused": self.paused})
+                          elif request.command == "stats":
+                              request.reply({"status": "ok", "deviceid": self.deviceId, "device": self.devicePath, "attached": self.deviceAttached,
+                                             "paused": self.paused, "realtime": realtime, "livetime": livetime, "countrate": countrate,
+                                             "totalcount": self.totalcounter, "disconnected": disconnected, "interval": self.loggingInterval,
+                                             "intervals": intervalSequence, "intervalRealtime": realtime - previousRealtime,
+                                             "intervalCount": sum(dict(self.counts).values())})
+                          elif request.command == "rate":
+                              if rate == None:
+                                  raise ValueError("Count rate history is disabled")
+                              seconds = float(request.args[0]) if request.args else 60.0
+                              timestamps, rateCounts, livetimes = rate.series(int(seconds / PASSCOUNTS_INTERVAL))
+                              request.reply({"status": "ok", "tick": PASSCOUNTS_INTERVAL, "timestamps": timestamps.tolist(),
+                                             "counts": rateCounts.tolist(), "livetimes": livetimes.tolist()})
+                          elif request.command == "stop":
+                              self.Terminated = True
+                              request.reply({"status": "ok"})
+                        except Exception as e:
+                          request.error("%s: %s" % (e.__class__.__name__, e))
 
                 elapsed_time = time.time() - start_time
-                if (elapsed_time >= self.config.loggingInterval):
+                if adaptive != None:
+                    closeInterval = adaptive.expired(elapsed_time, self.loggingInterval, self.totalcounter - intervalStartCounter, livetime - previousLivetime)
+                else:
+                    closeInterval = (elapsed_time >= self.loggingInterval)
+                if closeInterval or snapshotRequests:
                     start_time = time.time()
 
                     # Copy the counter so USB read thread can continue
@@ -243,63 +675,104 @@ class RadAngel():
                     loggingCounter = sum([loggingCounts[i] for i in loggingCounts])
                     loggingRealtime = realtime - previousRealtime
                     loggingLivetime = livetime - previousLivetime
+                    loggingDisconnected = disconnected - previousDisconnected
 
                     # Clear counter and channels
                     self.counts = {}
+                    intervalStartCounter = self.totalcounter
                     previousRealtime = realtime
                     previousLivetime = livetime
+                    previousDisconnected = disconnected
 
                     # Prepare for logging
                     now_utc = datetime.now(timezone('UTC'))
                     spectrum = ["%d" % (loggingCounts[i] if i in loggingCounts else 0) for i in range(4096)]
-                    cpm = float(loggingCounter)/loggingLivetime*60.0
+                    cpm = float(loggingCounter)/loggingLivetime*60.0 if loggingLivetime > 0 else 0.0
                     log = "%s,%s,%0.3f,%0.3f,%0.3f,%s,%s" % (now_utc.strftime(zulu_fmt), self.deviceId, loggingRealtime, loggingLivetime, cpm, loggingCounter, ",".join(spectrum))
                     logfile.write("%s\n" % log)
                     logfile.flush()
                     self.logPrint(log)
+                    if adaptive != None:
+                        if closeInterval:
+                            self.logPrint("Interval closed on %s after %0.3f seconds" % (adaptive.reason, loggingRealtime))
+                        adaptive.closed(loggingCounter, loggingLivetime)
 
                     # Keep union
                     channelsTotal = [x + y for x, y in zip(channelsTotal, [(loggingCounts[i] if i in loggingCounts else 0) for i in range(4096)])]
+                    intervalSequence += 1
+
+                    # Fan out to storage sinks
+                    record = {"deviceid": self.deviceId, "date": now_utc, "realtime": loggingRealtime, "livetime": loggingLivetime, "channels": [(loggingCounts[i] if i in loggingCounts else 0) for i in range(4096)], "cpm": cpm, "counts": loggingCounter}
+                    if loggingDisconnected > 0:
+                        self.logPrint("Device was disconnected %0.3f seconds during this interval" % loggingDisconnected)
+                        record["disconnected"] = loggingDisconnected
+                    if isotopes != None:
+                        # Fit before the interval is averaged into the background
+                        backgroundRate = background.background if background != None else None
+                        if self.config.isotopeSpectrum == "cumulative":
+                            record["isotopes"] = isotopes.identify(channelsTotal, livetime, backgroundRate, self.config.isotopeSigma)
+                        else:
+                            record["isotopes"] = isotopes.identify(record["channels"], loggingLivetime, backgroundRate, self.config.isotopeSigma)
+                        for name, result in record["isotopes"].items():
+                            if result["identified"]:
+                                self.logPrint("Identified %s (%0.1f counts, %0.1f sigma)" % (name, result["counts"], result["sigma"]))
+                    if background != None:
+                        result = background.update(record["channels"], loggingLivetime)
+                        if result != None:
+                            record["net"], record["netcounts"], alarm = result
+                            if alarm:
+                                self.logPrint("Alarm: net count %0.1f above background" % record["netcounts"])
+                                record["alarm"] = True
+                    for sink in sinks:
+                        try:
+                          sink.write(record)
+                        except:
+                          self.logPrint("Failed to write to %s" % sink.__class__.__name__)
+                          print '-'*60
+                          traceback.print_exc(file=sys.stdout)
+                          print '-'*60
+                          pass
+
+                    for request in snapshotRequests:
+                        request.reply({"status": "ok", "date": now_utc.strftime(zulu_fmt), "realtime": loggingRealtime,
+                                       "livetime": loggingLivetime, "cpm": cpm, "counts": loggingCounter, "interval": intervalSequence})
+                    snapshotRequests = []
+
+                if (checkpoint != None) and (time.time() - checkpoint_start_time >= self.config.checkpointInterval):
+                    checkpoint_start_time = time.time()
+                    checkpoint.save(self.deviceId, intervalSequence, self.totalcounter, realtime, livetime, previousRealtime, previousLivetime,
+                                    time.time() - start_time, dict(self.counts), channelsTotal)
 
-                    # Upload to database if needed
-                    if self.useDatabase:
-                        data = {"deviceid": self.deviceId, "date": now_utc, "realtime": loggingRealtime, "livetime": loggingLivetime, "channels": [(loggingCounts[i] if i in loggingCounts else 0) for i in range(4096)], "cpm": cpm, "counts": loggingCounter}
-                        cachedData.append(data)
+                if time.time() - sink_poll_start_time >= SINK_POLL_INTERVAL:
+                    sink_poll_start_time = time.time()
+                    for sink in sinks:
                         try:
-                          if len(cachedData) > 1:
-                            try:
-                              # We failed previously so we need to reconnect
-                              connection = MongoClient(self.config.db_host, self.config.db_port, socketTimeoutMS=self.config.networkTimeout, connectTimeoutMS=self.config.networkTimeout)
-                              db = connection[self.config.db_name]
-                              db.authenticate(self.config.db_user, self.config.db_passwd)
-                            except:
-                              self.logPrint("Database connection failed [%d item(s)]" % len(cachedData))
-                              print '-'*60
-                              traceback.print_exc(file=sys.stdout)
-                              print '-'*60
-                              pass
-
-                          bulkDataInsert = copy.deepcopy(cachedData)
-                          db.spectrum.insert(bulkDataInsert)
-                          self.logPrint("Database updated [%d item(s)]" % len(cachedData))
-                          cachedData = []
+                          sink.poll()
                         except:
-                          # Keep cached data and retry later
-                          self.logPrint("Failed to update database [%d item(s)]" % len(cachedData))
-                          connection.disconnect()
+                          self.logPrint("Failed to write to %s" % sink.__class__.__name__)
                           print '-'*60
                           traceback.print_exc(file=sys.stdout)
                           print '-'*60
                           pass
 
+                if (live != None) and (time.time() - live_start_time >= self.config.liveInterval):
+                    live_start_time = time.time()
+                    live.publish(realtime, livetime, countrate, self.totalcounter, intervalSequence,
+                                 realtime - previousRealtime, livetime - previousLivetime, dict(self.counts), channelsTotal, rate)
+
                 if ((self.captureTime > 0) and (realtime > self.captureTime)) or ((self.captureCount > 0) and (self.totalcounter > self.captureCount)):
                     # Union latest counts from unfinished period
                     channelsTotal = [x + y for x, y in zip(channelsTotal, [(self.counts[i] if i in self.counts else 0) for i in range(4096)])]
+                    captureCompleted = True
 
                     self.logPrint("Total captured time %0.3f completed" % realtime)
                     self.logPrint("  realtime = %0.3f, livetime = %0.3f, total count = %d, countrate = %0.3f" % (realtime, livetime, self.totalcounter, countrate))
                     break
 
+                if self.Terminated:
+                    self.logPrint("Capture stopped")
+                    break
+
                 time.sleep(0.0001) # force yield for other threads
 
         except:
@@ -310,21 +783,94 @@ class RadAngel():
             print '-'*60
         finally:
             self.logPrint( "Cleanup resources" )
+            if control != None:
+                for request in snapshotRequests:
+                    request.error("Capture ended")
+                control.stop()
             if usbRead != None:
                 usbRead.stop()
                 usbRead.join()
-            if hidDevice != None: hidDevice.close()
+                hidDevice = usbRead.hidDevice
+            if hidDevice != None: self.closeDevice(hidDevice)
             if logfile != None: logfile.close()
-
-            if len(cachedData):
-                # Dump data that couldn't make it to database for later insert
-                jsonpickle.set_encoder_options('simplejson', sort_keys=True)
-                open("cached_%s.json" % self.deviceId, "w").write(jsonpickle.encode(cachedData))
+            if live != None: live.close()
+            if rateLog != None: rateLog.close()
+
+            if checkpoint != None:
+                if captureCompleted:
+                    # Nothing to resume
+                    checkpoint.remove()
+                else:
+                    if usbRead != None:
+                        checkpoint.save(self.deviceId, intervalSequence, self.totalcounter, realtime, livetime, previousRealtime, previousLivetime,
+                                        time.time() - start_time, dict(self.counts), channelsTotal)
+                    checkpoint.close()
+
+            if background != None: background.close()
+
+            for sink in sinks:
+                try:
+                  sink.close()
+                except:
+                  traceback.print_exc(file=sys.stdout)
 
         self.logPrint( "Done" )
 
         return channelsTotal, realtime, livetime
 
+#
+# Configured devices watcher
+#
+# Starts a capture for each device of the [device] configuration section as
+# soon as it is plugged. A running capture re-attaches its own device when it
+# is plugged again, so each device id is started once.
+#
+class DeviceWatcher():
+    class CaptureThread(threading.Thread):
+        def __init__(self, radAngel):
+            threading.Thread.__init__(self)
+            self.radAngel = radAngel
+        def run(self):
+            channelsTotal, realtime, livetime = self.radAngel.Process()
+            speFilename = os.path.splitext(self.radAngel.logFilename)[0]+".spe"
+            export2SPE(speFilename, self.radAngel.deviceId, channelsTotal, realtime, livetime)
+
+    def __init__(self, config, options):
+        self.config = config
+        self.options = options
+        self.captures = {}
+
+    def scan(self):
+        if self.options.hidraw:
+            usbPathList = HIDRawDeviceList(USB_VENDOR_ID, USB_PRODUCT_ID)
+        else:
+            usbPathList = HIDDeviceList()
+        for devicepath in [path.replace("_",":").lower() for path in usbPathList]:
+            if devicepath not in self.config.devices:
+                continue
+            deviceid = self.config.devices[devicepath]
+            with RadAngel.devicePathsLock:
+                if deviceid in self.captures or devicepath in RadAngel.devicePathsInUse:
+                    continue
+            radAngel = RadAngel(self.config, deviceid, devicepath, "%s_raw.csv" % deviceid, self.options.database & dbSupport,
+                                self.options.capturetime, self.options.capturecount, not self.options.fresh, self.options.hidraw)
+            capture = DeviceWatcher.CaptureThread(radAngel)
+            self.captures[deviceid] = capture
+            capture.start()
+
+    def run(self):
+        try:
+            while True:
+                self.scan()
+                time.sleep(DEVICE_RESCAN_INTERVAL)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for capture in self.captures.values():
+                capture.radAngel.stop()
+            for capture in self.captures.values():
+                capture.join()
+
 # -----------------------------------------------------------------------------
 # Main
 # -----------------------------------------------------------------------------
@@ -332,6 +878,9 @@ if __name__ == '__main__':
   # Process command line options
   parser = OptionParser("Usage: radangel.py [options] <logfile>")
 
+  parser.add_option("-a", "--all",
+                      action="store_true", dest="all", default=False,
+                      help="capture all the configured devices, attaching them when plugged")
   parser.add_option("-c", "--capturecount",
                       type=int, dest="capturecount", default=0,
                       help="specify the total capture counts (default 0 meaning unlimited)")
@@ -341,30 +890,47 @@ if __name__ == '__main__':
   parser.add_option("-e", "--enumerate",
                       action="store_true", dest="enumerate", default=False,
                       help="enumerate USB HID devices only")
+  parser.add_option("-f", "--fresh",
+                      action="store_true", dest="fresh", default=False,
+                      help="start a fresh capture instead of resuming from the last checkpoint")
   parser.add_option("-i", "--deviceid",
                       type=str, dest="deviceid", default="000000-000000",
                       help="specify the device id (default 000000-000000)")
   parser.add_option("-p", "--path",
                       type=str, dest="path", default=None,
                       help="specify USB HID devices path to capture")
+  parser.add_option("-r", "--hidraw",
+                      action="store_true", dest="hidraw", default=False,
+                      help="use the Linux /dev/hidraw backend instead of hidapi")
   parser.add_option("-t", "--capturetime",
                       type=int, dest="capturetime", default=0,
                       help="specify the capture time in seconds (default 0 meaning unlimited)")
 
   (options, args) = parser.parse_args()
 
-  usbPathList = HIDDeviceList()
+  if not hidSupport and not options.hidraw:
+    print "No hidapi support"
+    sys.exit(1)
+
+  if options.hidraw:
+    usbPathList = HIDRawDeviceList(USB_VENDOR_ID, USB_PRODUCT_ID)
+  else:
+    usbPathList = HIDDeviceList()
   print "Available RadAngel devices =", usbPathList
   if options.enumerate:
     sys.exit(0)
 
+  # Load configuration
+  config = RadAngelConfiguration(".radangel.conf")
+
+  if options.all:
+    DeviceWatcher(config, options).run()
+    sys.exit(0)
+
   if len(usbPathList) == 0:
     print "No RadAngel device is connected"
     sys.exit(0)
 
-  # Load configuration
-  config = RadAngelConfiguration(".radangel.conf")
-
   # Select device path
   if options.path == None:
     devicepath = usbPathList[0].replace("_",":").lower()
@@ -384,6 +950,6 @@ if __name__ == '__main__':
     logFilename = "%s_raw.csv" % deviceid
   speFilename = os.path.splitext(logFilename)[0]+".spe"
 
-  radAngel = RadAngel(config, deviceid, devicepath, logFilename, options.database & dbSupport, options.capturetime, options.capturecount)
+  radAngel = RadAngel(config, deviceid, devicepath, logFilename, options.database & dbSupport, options.capturetime, options.capturecount, not options.fresh, options.hidraw)
   channelsTotal, realtime, livetime = radAngel.Process()
   export2SPE(speFilename, deviceid, channelsTotal, realtime, livetime)
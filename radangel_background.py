@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright (C) 2014  Lionel Bergeret
+#
+# ----------------------------------------------------------------
+# The contents of this file are distributed under the CC0 license.
+# See http://creativecommons.org/publicdomain/zero/1.0/
+# ----------------------------------------------------------------
+import math
+import json
+
+# numpy is optional, the pure python fallback gives the same results
+numpySupport = False
+try:
+    import numpy
+    numpySupport = True
+except:
+    pass
+
+NB_CHANNELS = 4096
+
+#
+# Running background spectrum
+#
+# The background is kept per channel as a count rate (counts per second of
+# livetime), updated at each closed interval with an exponentially weighted
+# moving average of weight alpha. The net spectrum of an interval is its
+# spectrum minus the background scaled to the interval livetime. When
+# alarmSigma is set, intervals whose net counts exceed alarmSigma standard
+# deviations of the expected background counts are flagged as alarms and
+# left out of the average, so a source does not leak into the background.
+#
+# Each interval costs O(channels) and the model survives restarts in
+# background_<deviceid>.json.
+#
+class BackgroundModel():
+    def __init__(self, deviceId, alpha, alarmSigma = 0.0, nbChannels = NB_CHANNELS):
+        self.filename = "background_%s.json" % deviceId
+        self.alpha = alpha
+        self.alarmSigma = alarmSigma
+        self.nbChannels = nbChannels
+        self.background = None # counts per second, per channel
+        self.backgroundRate = 0.0
+        self.intervals = 0
+
+    def open(self):
+        try:
+          data = json.load(open(self.filename))
+          if len(data["background"]) == self.nbChannels:
+              self.setBackground(data["background"])
+              self.intervals = data["intervals"]
+        except:
+          self.background = None
+
+    def close(self):
+        if self.background is not None:
+            data = {"intervals": self.intervals, "background": list(self.toList(self.background))}
+            json.dump(data, open(self.filename, "w"))
+
+    def setBackground(self, background):
+        if numpySupport:
+            self.background = numpy.array(background, dtype = numpy.float64)
+            self.backgroundRate = float(self.background.sum())
+        else:
+            self.background = [float(x) for x in background]
+            self.backgroundRate = sum(self.background)
+
+    def toList(self, values):
+        if numpySupport:
+            return values.tolist()
+        return values
+
+    def update(self, channels, livetime):
+        """Return (net spectrum, net counts, alarm) of the interval, None before the first background"""
+        if livetime <= 0:
+            return None
+        if self.background is None:
+            self.setBackground([float(x) / livetime for x in channels])
+            self.intervals = 1
+            return None
+
+        if numpySupport:
+            spectrum = numpy.asarray(channels, dtype = numpy.float64)
+            net = spectrum - self.background * livetime
+            netCounts = float(net.sum())
+        else:
+            net = [x - b * livetime for x, b in zip(channels, self.background)]
+            netCounts = sum(net)
+
+        expected = self.backgroundRate * livetime
+        alarm = (self.alarmSigma > 0) and (netCounts > self.alarmSigma * math.sqrt(max(expected, 1.0)))
+        if not alarm:
+            if numpySupport:
+                self.background += self.alpha * (spectrum / livetime - self.background)
+                self.backgroundRate = float(self.background.sum())
+            else:
+                self.background = [b + self.alpha * (float(x) / livetime - b) for x, b in zip(channels, self.background)]
+                self.backgroundRate = sum(self.background)
+            self.intervals += 1
+
+        return self.toList(net), netCounts, alarm
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright (C) 2014  Lionel Bergeret
+#
+# ----------------------------------------------------------------
+# The contents of this file are distributed under the CC0 license.
+# See http://creativecommons.org/publicdomain/zero/1.0/
+# ----------------------------------------------------------------
+import os
+import sys
+import json
+import socket
+import threading
+import Queue
+import SocketServer
+from optparse import OptionParser
+
+COMMANDS = ("snapshot", "spe", "rotate", "interval", "pause", "resume", "stats", "rate", "stop")
+REPLY_TIMEOUT = 5.0
+
+#
+# Control socket of a running capture
+#
+# One command per line ("interval 600", "spe /tmp/now.spe", ...), one JSON
+# reply per line. Commands are queued for the capture main loop, which
+# answers them between two passes, so the USB read thread is never blocked.
+# A command not taken by the main loop within REPLY_TIMEOUT is cancelled (and
+# reported as such), a command already taken is always replied to.
+#
+class ControlRequest():
+    def __init__(self, command, args):
+        self.command = command
+        self.args = args
+        self.result = None
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        self.started = False
+        self.cancelled = False
+
+    def start(self):
+        """Mark the request taken by the capture, False if it was cancelled"""
+        with self.lock:
+            if self.cancelled:
+                return False
+            self.started = True
+            return True
+
+    def cancel(self):
+        """Cancel the request, False if the capture already took it"""
+        with self.lock:
+            if self.started:
+                return False
+            self.cancelled = True
+            return True
+
+    def reply(self, result):
+        self.result = result
+        self.done.set()
+
+    def error(self, message):
+        self.reply({"status": "error", "message": message})
+
+class ControlHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            words = line.split()
+            if not words:
+                continue
+            request = ControlRequest(words[0].lower(), words[1:])
+            if request.command not in COMMANDS:
+                request.error("Unknown command %s (%s)" % (request.command, ", ".join(COMMANDS)))
+            else:
+                self.server.requests.put(request)
+                if not request.done.wait(REPLY_TIMEOUT):
+                    if request.cancel():
+                        request.error("No reply from the capture, command cancelled")
+                    else:
+                        # Being executed, wait for its outcome
+                        request.done.wait()
+            self.wfile.write("%s\n" % json.dumps(request.result, sort_keys=True))
+            self.wfile.flush()
+
+class ControlServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, filename):
+        if os.path.exists(filename):
+            os.remove(filename)
+        SocketServer.UnixStreamServer.__init__(self, filename, ControlHandler)
+        self.filename = filename
+        self.requests = Queue.Queue()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target = self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def pending(self):
+        """Return the queued requests without waiting (skipping the cancelled ones)"""
+        requests = []
+        while True:
+            try:
+              request = self.requests.get_nowait()
+            except Queue.Empty:
+              return requests
+            if request.start():
+                requests.append(request)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        for request in self.pending():
+            request.error("Capture ended")
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+#
+# Client
+#
+def sendCommand(filename, command, timeout = REPLY_TIMEOUT + 5.0):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    sock.connect(filename)
+    try:
+        sock.sendall("%s\n" % command)
+        data = ""
+        while not data.endswith("\n"):
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        sock.close()
+    return json.loads(data)
+
+# -----------------------------------------------------------------------------
+# Main
+# -----------------------------------------------------------------------------
+if __name__ == '__main__':
+  parser = OptionParser("Usage: radangel_control.py <socket> <command> [arguments]\n\n"
+                        "Commands:\n"
+                        "  snapshot          close the current logging interval now\n"
+                        "  spe [filename]    write the cumulated spectrum to an SPE file\n"
+                        "  rotate            rename the log file with a timestamp and reopen it\n"
+                        "  interval SECONDS  change the logging interval\n"
+                        "  pause, resume     suspend and resume the acquisition\n"
+                        "  stats             report the capture counters\n"
+                        "  rate [seconds]    count rate ticks of the last seconds (default 60)\n"
+                        "  stop              end the capture")
+
+  (options, args) = parser.parse_args()
+
+  if len(args) < 2:
+    parser.print_help()
+    sys.exit(0)
+
+  result = sendCommand(args[0], " ".join(args[1:]))
+  print json.dumps(result, sort_keys=True, indent=2)
+  if result.get("status") != "ok":
+    sys.exit(1)
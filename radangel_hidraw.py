@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright (C) 2014  Lionel Bergeret
+#
+# ----------------------------------------------------------------
+# The contents of this file are distributed under the CC0 license.
+# See http://creativecommons.org/publicdomain/zero/1.0/
+# ----------------------------------------------------------------
+import os
+import errno
+import fcntl
+import select
+
+SYSFS_HIDRAW = "/sys/class/hidraw"
+
+#
+# Linux native /dev/hidrawN backend (no cython-hidapi needed)
+#
+# Devices are found from sysfs and named with the same bus:device:interface
+# path as hidapi (e.g. 0003:0003:00) so the [device] configuration section
+# applies to both backends.
+#
+def readSysfs(path):
+    try:
+        return open(path).read().strip()
+    except IOError:
+        return None
+
+def hidrawEnumerate(vendorId, productId):
+    """Return the list of (path, devnode, usbdir) of the matching hidraw devices"""
+    devices = []
+    if not os.path.isdir(SYSFS_HIDRAW):
+        return devices
+    for name in sorted(os.listdir(SYSFS_HIDRAW)):
+        hidDir = os.path.realpath(os.path.join(SYSFS_HIDRAW, name, "device"))
+        uevent = readSysfs(os.path.join(hidDir, "uevent")) or ""
+        for line in uevent.splitlines():
+            if line.startswith("HID_ID="):
+                bus, vendor, product = line[7:].split(":")
+                if int(vendor, 16) == vendorId and int(product, 16) == productId:
+                    interfaceDir = os.path.dirname(hidDir)
+                    usbDir = os.path.dirname(interfaceDir)
+                    busnum = int(readSysfs(os.path.join(usbDir, "busnum")) or 0)
+                    devnum = int(readSysfs(os.path.join(usbDir, "devnum")) or 0)
+                    interface = int(readSysfs(os.path.join(interfaceDir, "bInterfaceNumber")) or "0", 16)
+                    path = "%04x:%04x:%02x" % (busnum, devnum, interface)
+                    devices.append((path, os.path.join("/dev", name), usbDir))
+    return devices
+
+def HIDRawDeviceList(vendorId, productId):
+    return [path for path, devnode, usbDir in hidrawEnumerate(vendorId, productId)]
+
+class HidrawDevice():
+    def __init__(self, vendorId, productId):
+        self.vendorId = vendorId
+        self.productId = productId
+        self.fd = None
+        self.epoll = None
+        self.usbDir = None
+        self.pending = []
+
+    def open_fd(self, fd):
+        """Use an already opened file descriptor (a SOCK_SEQPACKET socket keeps the report framing in tests)"""
+        self.fd = fd
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.epoll = select.epoll()
+        self.epoll.register(fd, select.EPOLLIN)
+
+    def open_path(self, path):
+        for devicePath, devnode, usbDir in hidrawEnumerate(self.vendorId, self.productId):
+            if path in (devicePath, devnode):
+                self.usbDir = usbDir
+                self.open_fd(os.open(devnode, os.O_RDONLY | os.O_NONBLOCK))
+                return
+        raise IOError("No hidraw device for %s" % path)
+
+    def open(self, vendorId, productId):
+        devices = hidrawEnumerate(vendorId, productId)
+        if not devices:
+            raise IOError("No hidraw device %04x:%04x" % (vendorId, productId))
+        self.open_path(devices[0][0])
+
+    def get_manufacturer_string(self):
+        return self.usbDir and readSysfs(os.path.join(self.usbDir, "manufacturer"))
+
+    def get_product_string(self):
+        return self.usbDir and readSysfs(os.path.join(self.usbDir, "product"))
+
+    def readReports(self, size, timeout_ms = 0):
+        """Wait up to timeout_ms for data and return all the pending reports"""
+        reports = []
+        if not self.epoll.poll(timeout_ms / 1000.0):
+            return reports
+        while True:
+            try:
+                data = os.read(self.fd, size)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if not data:
+                raise IOError("Device disconnected")
+            reports.append(bytearray(data))
+        return reports
+
+    def read(self, size, timeout_ms = 0):
+        """hidapi compatible single report read (list of ints, empty on timeout)"""
+        if not self.pending:
+            self.pending = self.readReports(size, timeout_ms)
+            self.pending.reverse()
+        if self.pending:
+            return list(self.pending.pop())
+        return []
+
+    def close(self):
+        if self.epoll != None:
+            self.epoll.close()
+            self.epoll = None
+        if self.fd != None:
+            os.close(self.fd)
+            self.fd = None
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright (C) 2014  Lionel Bergeret
+#
+# ----------------------------------------------------------------
+# The contents of this file are distributed under the CC0 license.
+# See http://creativecommons.org/publicdomain/zero/1.0/
+# ----------------------------------------------------------------
+import os
+import sys
+import glob
+import time
+from optparse import OptionParser
+
+from radangel_spe import readSPE, KROMEK_ENERGY_FIT
+
+# Isotope identification needs numpy
+numpySupport = False
+try:
+    import numpy
+    numpySupport = True
+except:
+    pass
+
+NB_CHANNELS = 4096
+MIN_ENERGY = 30.0 # keV, below is the LLD and noise region
+
+#
+# Non negative least squares (Lawson-Hanson active set) on the normal
+# equations G x = b, with G = A'A precomputed once for the template matrix A
+#
+def nnls(G, b, tolerance = 1e-10):
+    size = len(b)
+    x = numpy.zeros(size)
+    passive = numpy.zeros(size, dtype = bool)
+    w = b - G.dot(x)
+    for iteration in range(3 * size):
+        if passive.all() or w[~passive].max() <= tolerance:
+            break
+        passive[numpy.argmax(numpy.where(passive, -numpy.inf, w))] = True
+        while True:
+            z = numpy.zeros(size)
+            index = numpy.flatnonzero(passive)
+            z[index] = numpy.linalg.lstsq(G[numpy.ix_(index, index)], b[index], rcond = None)[0]
+            if (z[index] > tolerance).all():
+                x = z
+                break
+            # Step back to the feasible region and drop the templates which reached zero
+            negative = passive & (z <= tolerance)
+            alpha = (x[negative] / (x[negative] - z[negative])).min()
+            x = x + alpha * (z - x)
+            passive &= (x > tolerance)
+            x[~passive] = 0.0
+        w = b - G.dot(x)
+    return x, passive
+
+#
+# Template library
+#
+# Each reference template is an SPE file of the library directory (the file
+# name gives the isotope, e.g. Cs137.spe), ideally background subtracted. The
+# templates are resampled on the detector energy calibration, restricted to
+# the fit region and normalized to unit area, so the fitted coefficient of a
+# template is the number of counts it contributes to the spectrum.
+#
+class IsotopeLibrary():
+    def __init__(self, directory, energyFit = KROMEK_ENERGY_FIT, nbChannels = NB_CHANNELS):
+        self.directory = directory
+        self.energyFit = energyFit
+        self.nbChannels = nbChannels
+        self.names = []
+        self.templates = None # nbChannels x templates matrix
+        self.gram = None # templates' x templates
+
+    def load(self):
+        energies = self.energyFit[0] + self.energyFit[1] * numpy.arange(self.nbChannels)
+        self.fitRegion = energies >= MIN_ENERGY
+        columns = []
+        for filename in sorted(glob.glob(os.path.join(self.directory, "*.spe"))):
+            spectrum = readSPE(filename)
+            counts = numpy.asarray(spectrum.channels, dtype = numpy.float64)
+            a, b = spectrum.energyFit or KROMEK_ENERGY_FIT
+            # Linear interpolation of the template at the detector channel energies
+            template = numpy.interp((energies - a) / b, numpy.arange(len(counts)), counts, left = 0.0, right = 0.0)
+            template[~self.fitRegion] = 0.0
+            area = template.sum()
+            if area <= 0:
+                continue
+            self.names.append(os.path.splitext(os.path.basename(filename))[0])
+            columns.append(template / area)
+        if not columns:
+            raise IOError("No template in %s" % self.directory)
+        self.templates = numpy.column_stack(columns)
+        self.gram = self.templates.T.dot(self.templates)
+
+    def identify(self, channels, livetime, background = None, sigma = 3.0):
+        """Fit the templates to the spectrum (minus the background rate spectrum scaled to livetime)
+
+        Return a dictionary isotope -> {"counts", "rate", "sigma", "identified"} for the
+        templates with a positive contribution, sigma being the significance of the counts."""
+        counts = numpy.asarray(channels, dtype = numpy.float64)
+        spectrum = counts
+        if background is not None:
+            spectrum = counts - numpy.asarray(background) * livetime
+        spectrum = numpy.where(self.fitRegion, spectrum, 0.0)
+        x, passive = nnls(self.gram, self.templates.T.dot(spectrum))
+
+        results = {}
+        index = numpy.flatnonzero(passive)
+        if len(index) == 0:
+            return results
+        # Poisson covariance of the fitted counts: G^-1 A' diag(counts) A G^-1
+        A = self.templates[:, index]
+        inverse = numpy.linalg.pinv(self.gram[numpy.ix_(index, index)])
+        variance = numpy.maximum(counts, 1.0)
+        covariance = inverse.dot(A.T.dot(A * variance[:, None])).dot(inverse)
+        for k, i in enumerate(index):
+            error = numpy.sqrt(max(covariance[k, k], 1e-12))
+            results[self.names[i]] = {"counts": float(x[i]), "rate": float(x[i] / livetime) if livetime > 0 else 0.0,
+                                      "sigma": float(x[i] / error), "identified": bool(x[i] / error >= sigma)}
+        return results
+
+# -----------------------------------------------------------------------------
+# Main
+# -----------------------------------------------------------------------------
+if __name__ == '__main__':
+  # Process command line options
+  parser = OptionParser("Usage: radangel_isotope.py [options] <spefile> [<spefile> ...]")
+
+  parser.add_option("-l", "--library",
+                      type=str, dest="library", default="isotopes",
+                      help="specify the directory of the SPE templates (default isotopes)")
+  parser.add_option("-b", "--background",
+                      type=str, dest="background", default=None,
+                      help="specify a background SPE file to subtract")
+  parser.add_option("-s", "--sigma",
+                      type=float, dest="sigma", default=3.0,
+                      help="specify the identification threshold in sigma (default 3.0)")
+
+  (options, args) = parser.parse_args()
+
+  if len(args) == 0:
+    parser.print_help()
+    sys.exit(0)
+
+  if not numpySupport:
+    print "No numpy support"
+    sys.exit(1)
+
+  library = IsotopeLibrary(options.library)
+  library.load()
+  print "Templates:", ", ".join(library.names)
+
+  background = None
+  if options.background != None:
+    backgroundSpectrum = readSPE(options.background)
+    background = numpy.asarray(backgroundSpectrum.channels, dtype = numpy.float64) / backgroundSpectrum.livetime
+
+  for filename in args:
+    spectrum = readSPE(filename)
+    start_time = time.time()
+    results = library.identify(spectrum.channels, spectrum.livetime, background, options.sigma)
+    print "%s (%0.3f ms)" % (filename, (time.time() - start_time) * 1000.0)
+    for name in sorted(results, key = lambda name: -results[name]["sigma"]):
+      result = results[name]
+      print "  %-12s %s counts = %0.1f, rate = %0.3f cps, %0.1f sigma" % (name, "*" if result["identified"] else " ",
+            result["counts"], result["rate"], result["sigma"])
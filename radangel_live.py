@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright (C) 2014  Lionel Bergeret
+#
+# ----------------------------------------------------------------
+# The contents of this file are distributed under the CC0 license.
+# See http://creativecommons.org/publicdomain/zero/1.0/
+# ----------------------------------------------------------------
+import os
+import sys
+import mmap
+import time
+import array
+import struct
+from optparse import OptionParser
+
+NB_CHANNELS = 4096
+RATE_TICKS = 600 # count rate history (one minute of 0.1 second ticks)
+
+#
+# Live histogram segment
+#
+# The capture process publishes its current interval histogram, the cumulated
+# histogram of the closed intervals and its counters in a memory mapped file
+# (in /dev/shm by default) that any number of local readers can map.
+#
+# Consistency is ensured with a seqlock: the writer makes the version counter
+# odd before updating the segment and even again afterwards, readers retry
+# their copy until they read the same even version before and after it.
+#
+#   version    uint64 seqlock counter
+#   header     magic, layout version, device id, timestamp, realtime, livetime,
+#              countrate, total counter, interval sequence, interval realtime,
+#              interval livetime, interval counter, number of rate ticks
+#   interval   current interval histogram, NB_CHANNELS x uint32
+#   totals     cumulated histogram of the closed intervals, NB_CHANNELS x double
+#   rate       latest count rate ticks, oldest first: RATE_TICKS x double
+#              timestamps, RATE_TICKS x uint32 counts, RATE_TICKS x double livetimes
+#
+LIVE_MAGIC = "RALV"
+LIVE_LAYOUT = 2
+LIVE_VERSION = struct.Struct("<Q")
+LIVE_HEADER = struct.Struct("<4sI32sddddQQddQQ")
+
+INTERVAL_TYPECODE = "I"
+TOTALS_TYPECODE = "d"
+assert array.array(INTERVAL_TYPECODE).itemsize == 4
+
+HEADER_OFFSET = LIVE_VERSION.size
+INTERVAL_OFFSET = HEADER_OFFSET + LIVE_HEADER.size
+TOTALS_OFFSET = INTERVAL_OFFSET + NB_CHANNELS * 4
+RATE_OFFSET = TOTALS_OFFSET + NB_CHANNELS * 8
+SEGMENT_SIZE = RATE_OFFSET + RATE_TICKS * 20
+
+def defaultLiveFilename(deviceId):
+    if os.path.isdir("/dev/shm"):
+        return "/dev/shm/radangel_%s.live" % deviceId
+    return None
+
+#
+# Writer (capture process)
+#
+class LiveHistogramWriter():
+    def __init__(self, filename, deviceId):
+        self.filename = filename
+        self.deviceId = deviceId
+        self.file = None
+        self.map = None
+        self.version = 0
+        self.totals = None
+
+    def open(self):
+        self.file = open(self.filename, "w+b")
+        self.file.truncate(SEGMENT_SIZE)
+        self.map = mmap.mmap(self.file.fileno(), SEGMENT_SIZE)
+
+    def close(self):
+        if self.map != None:
+            self.map.close()
+            self.map = None
+        if self.file != None:
+            self.file.close()
+            self.file = None
+            os.remove(self.filename)
+
+    def publish(self, realtime, livetime, countrate, totalcounter, intervalSequence,
+                intervalRealtime, intervalLivetime, counts, channelsTotal, rate = None):
+        interval = array.array(INTERVAL_TYPECODE, [0]) * NB_CHANNELS
+        intervalCounter = 0
+        for channel, count in counts.iteritems():
+            interval[channel] = count
+            intervalCounter += count
+        # The cumulated histogram only changes when an interval closes
+        totals = None
+        if channelsTotal is not self.totals:
+            totals = array.array(TOTALS_TYPECODE, channelsTotal).tostring()
+            self.totals = channelsTotal
+        # Count rate history from the RateRingBuffer
+        rateTicks = 0
+        if rate != None:
+            timestamps, rateCounts, livetimes = rate.series(RATE_TICKS)
+            rateTicks = len(timestamps)
+            padding = RATE_TICKS - rateTicks
+            rate = (timestamps + array.array("d", [0.0]) * padding).tostring() + \
+                   (rateCounts + array.array("I", [0]) * padding).tostring() + \
+                   (livetimes + array.array("d", [0.0]) * padding).tostring()
+        header = LIVE_HEADER.pack(LIVE_MAGIC, LIVE_LAYOUT, self.deviceId, time.time(), realtime, livetime, countrate,
+                                  totalcounter, intervalSequence, intervalRealtime, intervalLivetime, intervalCounter, rateTicks)
+        interval = interval.tostring()
+
+        self.version += 1 # odd, update in progress
+        LIVE_VERSION.pack_into(self.map, 0, self.version)
+        self.map[HEADER_OFFSET:INTERVAL_OFFSET] = header
+        self.map[INTERVAL_OFFSET:TOTALS_OFFSET] = interval
+        if totals != None:
+            self.map[TOTALS_OFFSET:RATE_OFFSET] = totals
+        if rate != None:
+            self.map[RATE_OFFSET:SEGMENT_SIZE] = rate
+        self.version += 1 # even, consistent
+        LIVE_VERSION.pack_into(self.map, 0, self.version)
+
+#
+# Reader library
+#
+class LiveSnapshot():
+    def __init__(self, version, header, interval, totals, rate):
+        self.version = version
+        (magic, layout, deviceId, self.timestamp, self.realtime, self.livetime, self.countrate, self.totalcounter,
+         self.intervalSequence, self.intervalRealtime, self.intervalLivetime, self.intervalCounter, rateTicks) = header
+        self.deviceId = deviceId.rstrip("\0")
+        self.interval = interval
+        self.totals = totals
+        self.rate = rate # (timestamps, counts, livetimes) arrays
+
+    def cumulative(self):
+        """Histogram since the capture start (closed intervals plus current one)"""
+        return [int(x) + y for x, y in zip(self.totals, self.interval)]
+
+class LiveHistogramReader():
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, "rb")
+        self.map = mmap.mmap(self.file.fileno(), SEGMENT_SIZE, access = mmap.ACCESS_READ)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def snapshot(self, timeout = 1.0):
+        """Return a consistent LiveSnapshot (None if the writer never published)"""
+        deadline = time.time() + timeout
+        while True:
+            (before,) = LIVE_VERSION.unpack_from(self.map, 0)
+            if before > 0 and before % 2 == 0:
+                data = self.map[HEADER_OFFSET:SEGMENT_SIZE]
+                (after,) = LIVE_VERSION.unpack_from(self.map, 0)
+                if before == after:
+                    break
+            elif before == 0:
+                return None
+            if time.time() > deadline:
+                raise IOError("No consistent snapshot of %s" % self.filename)
+            time.sleep(0.0001)
+
+        header = LIVE_HEADER.unpack_from(data, 0)
+        if header[0] != LIVE_MAGIC or header[1] != LIVE_LAYOUT:
+            raise IOError("%s is not a live histogram segment" % self.filename)
+        interval = array.array(INTERVAL_TYPECODE)
+        interval.fromstring(data[INTERVAL_OFFSET - HEADER_OFFSET:TOTALS_OFFSET - HEADER_OFFSET])
+        totals = array.array(TOTALS_TYPECODE)
+        totals.fromstring(data[TOTALS_OFFSET - HEADER_OFFSET:RATE_OFFSET - HEADER_OFFSET])
+        rateTicks = header[-1]
+        rate = []
+        offset = RATE_OFFSET - HEADER_OFFSET
+        for typecode, itemsize in (("d", 8), ("I", 4), ("d", 8)):
+            values = array.array(typecode)
+            values.fromstring(data[offset:offset + rateTicks * itemsize])
+            rate.append(values)
+            offset += RATE_TICKS * itemsize
+        return LiveSnapshot(before, header, interval, totals, tuple(rate))
+
+# -----------------------------------------------------------------------------
+# Main
+# -----------------------------------------------------------------------------
+if __name__ == '__main__':
+  # Process command line options
+  parser = OptionParser("Usage: radangel_live.py [options] <livefile>")
+
+  parser.add_option("-w", "--watch",
+                      type=float, dest="watch", default=0.0,
+                      help="print a snapshot every WATCH seconds (default 0 meaning once)")
+
+  (options, args) = parser.parse_args()
+
+  if len(args) != 1:
+    parser.print_help()
+    sys.exit(0)
+
+  reader = LiveHistogramReader(args[0])
+  try:
+    while True:
+      snapshot = reader.snapshot()
+      if snapshot != None:
+        print "%s: realtime = %0.3f, livetime = %0.3f, total count = %d, countrate = %0.3f, interval #%d count = %d" % (snapshot.deviceId,
+              snapshot.realtime, snapshot.livetime, snapshot.totalcounter, snapshot.countrate, snapshot.intervalSequence, snapshot.intervalCounter)
+      if options.watch <= 0:
+        break
+      time.sleep(options.watch)
+  except KeyboardInterrupt:
+    pass
+  finally:
+    reader.close()
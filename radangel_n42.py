@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright (C) 2014  Lionel Bergeret
+#
+# ----------------------------------------------------------------
+# The contents of this file are distributed under the CC0 license.
+# See http://creativecommons.org/publicdomain/zero/1.0/
+# ----------------------------------------------------------------
+import sys
+import uuid
+from datetime import datetime, timedelta
+from optparse import OptionParser
+from xml.sax.saxutils import escape, quoteattr
+
+from radangel_spe import KROMEK_ENERGY_FIT
+
+zulu_fmt = "%Y-%m-%dT%H:%M:%SZ"
+
+#
+# Interval records from the raw log file
+#
+# Each line is date,deviceid,realtime,livetime,cpm,counts,4096 channels (the
+# date being the end of the interval). Lines are parsed one at a time.
+#
+def logRecords(filename, deviceId = None, start = None, end = None):
+    for line in open(filename):
+        fields = line.rstrip().split(",")
+        if len(fields) < 7:
+            continue
+        if deviceId != None and fields[1] != deviceId:
+            continue
+        date = datetime.strptime(fields[0], zulu_fmt)
+        if (start != None and date < start) or (end != None and date > end):
+            continue
+        yield {"deviceid": fields[1], "date": date, "realtime": float(fields[2]), "livetime": float(fields[3]),
+               "cpm": float(fields[4]), "counts": int(fields[5]), "channels": [int(x) for x in fields[6:]]}
+
+#
+# N42 (ANSI N42.42-2011) export
+#
+# The document is written incrementally: header, then one RadMeasurement per
+# interval record as it comes, then the closing tags, so memory use does not
+# depend on the number of spectra. Channel data use the CountedZeroes
+# compression (each run of zeros written as "0 <run length>").
+#
+def countedZeroes(channels):
+    values = []
+    zeros = 0
+    for count in channels:
+        if count == 0:
+            zeros += 1
+            continue
+        if zeros:
+            values.append("0 %d" % zeros)
+            zeros = 0
+        values.append("%d" % count)
+    if zeros:
+        values.append("0 %d" % zeros)
+    return " ".join(values)
+
+def duration(seconds):
+    return "PT%0.3fS" % seconds
+
+class N42Writer():
+    def __init__(self, filename, energyFit = KROMEK_ENERGY_FIT):
+        self.filename = filename
+        self.energyFit = energyFit
+        self.file = None
+        self.count = 0
+
+    def open(self):
+        self.file = open(self.filename, "w")
+        self.file.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        self.file.write('<RadInstrumentData xmlns="http://physics.nist.gov/N42/2011/N42" n42DocUUID=%s>\n' % quoteattr(str(uuid.uuid4())))
+        self.file.write('  <RadInstrumentDataCreatorName>radangel</RadInstrumentDataCreatorName>\n')
+        self.file.write('  <RadInstrumentInformation id="RadInstrumentInformation-1">\n')
+        self.file.write('    <RadInstrumentManufacturerName>Kromek</RadInstrumentManufacturerName>\n')
+        self.file.write('    <RadInstrumentModelName>RadAngel</RadInstrumentModelName>\n')
+        self.file.write('    <RadInstrumentClassCode>Spectroscopic Personal Radiation Detector</RadInstrumentClassCode>\n')
+        self.file.write('  </RadInstrumentInformation>\n')
+        self.file.write('  <RadDetectorInformation id="RadDetectorInformation-1">\n')
+        self.file.write('    <RadDetectorCategoryCode>Gamma</RadDetectorCategoryCode>\n')
+        self.file.write('    <RadDetectorKindCode>CZT</RadDetectorKindCode>\n')
+        self.file.write('  </RadDetectorInformation>\n')
+        self.file.write('  <EnergyCalibration id="EnergyCalibration-1">\n')
+        self.file.write('    <CoefficientValues>%r %r 0</CoefficientValues>\n' % self.energyFit)
+        self.file.write('  </EnergyCalibration>\n')
+
+    def write(self, record):
+        self.count += 1
+        start = record["date"] - timedelta(seconds = record["realtime"])
+        self.file.write('  <RadMeasurement id="RadMeasurement-%d">\n' % self.count)
+        self.file.write('    <Remark>%s</Remark>\n' % escape("device id %s" % record["deviceid"]))
+        self.file.write('    <MeasurementClassCode>Foreground</MeasurementClassCode>\n')
+        self.file.write('    <StartDateTime>%sZ</StartDateTime>\n' % start.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3])
+        self.file.write('    <RealTimeDuration>%s</RealTimeDuration>\n' % duration(record["realtime"]))
+        self.file.write('    <Spectrum id="Spectrum-%d" radDetectorInformationReference="RadDetectorInformation-1" '
+                        'energyCalibrationReference="EnergyCalibration-1">\n' % self.count)
+        self.file.write('      <LiveTimeDuration>%s</LiveTimeDuration>\n' % duration(record["livetime"]))
+        self.file.write('      <ChannelData compressionCode="CountedZeroes">%s</ChannelData>\n' % countedZeroes(record["channels"]))
+        self.file.write('    </Spectrum>\n')
+        self.file.write('  </RadMeasurement>\n')
+
+    def close(self):
+        if self.file != None:
+            self.file.write('</RadInstrumentData>\n')
+            self.file.close()
+            self.file = None
+
+# -----------------------------------------------------------------------------
+# Main
+# -----------------------------------------------------------------------------
+if __name__ == '__main__':
+  # Process command line options
+  parser = OptionParser("Usage: radangel_n42.py [options] <n42file> [<logfile>]")
+
+  parser.add_option("-i", "--deviceid",
+                      type=str, dest="deviceid", default=None,
+                      help="specify the device id (required with -q)")
+  parser.add_option("-q", "--sqlite",
+                      type=str, dest="sqlite", default=None,
+                      help="read the records from this SQLite sink file instead of a log file")
+  parser.add_option("-s", "--start",
+                      type=str, dest="start", default=None,
+                      help="specify the range start date (%s)" % zulu_fmt.replace("%", "%%"))
+  parser.add_option("-e", "--end",
+                      type=str, dest="end", default=None,
+                      help="specify the range end date (%s)" % zulu_fmt.replace("%", "%%"))
+
+  (options, args) = parser.parse_args()
+
+  if len(args) != (1 if options.sqlite else 2) or (options.sqlite and options.deviceid == None):
+    parser.print_help()
+    sys.exit(0)
+
+  start = datetime.strptime(options.start, zulu_fmt) if options.start else None
+  end = datetime.strptime(options.end, zulu_fmt) if options.end else None
+
+  sink = None
+  if options.sqlite:
+    from radangel_sinks import SQLiteSink
+    sink = SQLiteSink(options.sqlite)
+    sink.open()
+    records = sink.records(options.deviceid, start, end)
+  else:
+    records = logRecords(args[1], options.deviceid, start, end)
+
+  writer = N42Writer(args[0])
+  writer.open()
+  try:
+    for record in records:
+      writer.write(record)
+  finally:
+    writer.close()
+    if sink != None:
+      sink.close()
+  print "%d spectra exported to %s" % (writer.count, args[0])
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright (C) 2014  Lionel Bergeret
+#
+# ----------------------------------------------------------------
+# The contents of this file are distributed under the CC0 license.
+# See http://creativecommons.org/publicdomain/zero/1.0/
+# ----------------------------------------------------------------
+import sys
+from datetime import datetime
+from optparse import OptionParser
+
+zulu_fmt = "%Y-%m-%dT%H:%M:%SZ"
+
+#
+# Database indexes used by the sinks and the range queries
+#
+def ensureIndexes(db):
+    db.spectrum.ensure_index([("deviceid", 1), ("date", 1)])
+    db.spectrum_bucket.ensure_index([("deviceid", 1), ("date", 1)], unique=True)
+
+#
+# Aggregation helpers
+#
+def aggregate(collection, pipeline):
+    result = collection.aggregate(pipeline)
+    if isinstance(result, dict): # pymongo 2.x
+        return result["result"]
+    return list(result)
+
+def intervalFields(prefix):
+    # Keep only the summed fields (of an unwound interval) so that the
+    # channels $unwind does not copy whole bucket documents
+    return {"$project": {"realtime": "$%srealtime" % prefix, "livetime": "$%slivetime" % prefix,
+                         "counts": "$%scounts" % prefix, "channels": "$%schannels" % prefix}}
+
+def sumPipelines(collection, head, channels, realtime, livetime):
+    # Times and counts summed over the matching documents
+    for doc in aggregate(collection, head + [{"$group": {"_id": None, "realtime": {"$sum": "$realtime"}, "livetime": {"$sum": "$livetime"}}}]):
+        realtime += doc["realtime"]
+        livetime += doc["livetime"]
+
+    # Channel arrays summed element wise on the server (one document per channel comes back),
+    # either dense count arrays or the sparse {c: channel, n: count} lists of the bucket intervals
+    for doc in aggregate(collection, head + [{"$unwind": {"path": "$channels", "includeArrayIndex": "channel"}},
+                                             {"$group": {"_id": {"$ifNull": ["$channels.c", "$channel"]},
+                                                         "count": {"$sum": {"$ifNull": ["$channels.n", "$channels"]}}}}]):
+        channels[int(doc["_id"])] += doc["count"]
+
+    return realtime, livetime
+
+#
+# Sum of all the spectra of a device between start (included) and end (excluded)
+#
+# Both the per interval spectrum collection and the spectrum_bucket collection
+# are queried: buckets fully inside the range use their pre-aggregated totals,
+# buckets overlapping the range boundaries are unwound to their intervals.
+# Returns (channels, realtime, livetime) ready for export2SPE.
+#
+def rangeSpectrum(db, deviceId, start, end, nbChannels = 4096):
+    channels = [0 for i in range(nbChannels)]
+    realtime = 0.0
+    livetime = 0.0
+
+    dateRange = {"$gte": start, "$lt": end}
+
+    # One document per interval
+    head = [{"$match": {"deviceid": deviceId, "date": dateRange}},
+            intervalFields("")]
+    realtime, livetime = sumPipelines(db.spectrum, head, channels, realtime, livetime)
+
+    # Buckets fully inside the range
+    head = [{"$match": {"deviceid": deviceId, "date": {"$gte": start}, "end": {"$lte": end}}},
+            intervalFields("")]
+    realtime, livetime = sumPipelines(db.spectrum_bucket, head, channels, realtime, livetime)
+
+    # Buckets overlapping the range boundaries
+    head = [{"$match": {"deviceid": deviceId, "date": {"$lt": end}, "end": {"$gt": start},
+                        "$or": [{"date": {"$lt": start}}, {"end": {"$gt": end}}]}},
+            {"$project": {"intervals": 1}},
+            {"$unwind": "$intervals"},
+            {"$match": {"intervals.date": dateRange}},
+            intervalFields("intervals.")]
+    realtime, livetime = sumPipelines(db.spectrum_bucket, head, channels, realtime, livetime)
+
+    return channels, realtime, livetime
+
+# -----------------------------------------------------------------------------
+# Main
+# -----------------------------------------------------------------------------
+if __name__ == '__main__':
+  from radangel import RadAngelConfiguration, export2SPE
+  from pymongo import MongoClient
+
+  # Process command line options
+  parser = OptionParser("Usage: radangel_query.py [options] <spefile>")
+
+  parser.add_option("-i", "--deviceid",
+                      type=str, dest="deviceid", default="000000-000000",
+                      help="specify the device id (default 000000-000000)")
+  parser.add_option("-s", "--start",
+                      type=str, dest="start", default=None,
+                      help="specify the range start date (%s)" % zulu_fmt.replace("%", "%%"))
+  parser.add_option("-e", "--end",
+                      type=str, dest="end", default=None,
+                      help="specify the range end date (%s, default now)" % zulu_fmt.replace("%", "%%"))
+  parser.add_option("-x", "--indexes",
+                      action="store_true", dest="indexes", default=False,
+                      help="create the database indexes")
+
+  (options, args) = parser.parse_args()
+
+  config = RadAngelConfiguration(".radangel.conf")
+  connection = MongoClient(config.db_host, config.db_port, socketTimeoutMS=config.networkTimeout, connectTimeoutMS=config.networkTimeout)
+  db = connection[config.db_name]
+  db.authenticate(config.db_user, config.db_passwd)
+
+  if options.indexes:
+    ensureIndexes(db)
+
+  if len(args) != 1 or options.start == None:
+    if not options.indexes:
+      parser.print_help()
+    sys.exit(0)
+
+  start = datetime.strptime(options.start, zulu_fmt)
+  if options.end == None:
+    end = datetime.utcnow()
+  else:
+    end = datetime.strptime(options.end, zulu_fmt)
+
+  channels, realtime, livetime = rangeSpectrum(db, options.deviceid, start, end)
+  print "%s: realtime = %0.3f, livetime = %0.3f, total count = %d" % (options.deviceid, realtime, livetime, sum(channels))
+  export2SPE(args[0], options.deviceid, channels, realtime, livetime)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright (C) 2014  Lionel Bergeret
+#
+# ----------------------------------------------------------------
+# The contents of this file are distributed under the CC0 license.
+# See http://creativecommons.org/publicdomain/zero/1.0/
+# ----------------------------------------------------------------
+import math
+import array
+from datetime import datetime
+
+#
+# Count rate time series
+#
+# The capture main loop appends one tick (timestamp, counts, livetime) every
+# PASSCOUNTS_INTERVAL to a fixed size ring buffer backed by arrays, so the
+# sub-second rate history of the last minutes is kept without any allocation.
+# The ticks are also summed into periods of rate_log_period seconds written to
+# a compact CSV rate log (date, counts, livetime, counts per second).
+#
+class RateRingBuffer():
+    def __init__(self, size):
+        self.size = size
+        self.timestamps = array.array("d", [0.0]) * size
+        self.counts = array.array("I", [0]) * size
+        self.livetimes = array.array("d", [0.0]) * size
+        self.index = 0 # number of ticks appended since start
+
+    def append(self, timestamp, counts, livetime):
+        i = self.index % self.size
+        self.timestamps[i] = timestamp
+        self.counts[i] = counts
+        self.livetimes[i] = livetime
+        self.index += 1
+
+    def __len__(self):
+        return min(self.index, self.size)
+
+    def series(self, ticks = None):
+        """Return the (timestamps, counts, livetimes) arrays of the last ticks, oldest first"""
+        length = len(self)
+        if ticks != None:
+            length = min(length, ticks)
+        end = self.index % self.size
+        start = end - length
+        if start >= 0:
+            return self.timestamps[start:end], self.counts[start:end], self.livetimes[start:end]
+        return (self.timestamps[start:] + self.timestamps[:end], self.counts[start:] + self.counts[:end],
+                self.livetimes[start:] + self.livetimes[:end])
+
+    def since(self, timestamp):
+        """Return the series of the ticks after timestamp"""
+        timestamps, counts, livetimes = self.series()
+        # Binary search, timestamps are increasing
+        low, high = 0, len(timestamps)
+        while low < high:
+            middle = (low + high) // 2
+            if timestamps[middle] <= timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return timestamps[low:], counts[low:], livetimes[low:]
+
+class RateLog():
+    def __init__(self, filename, period = 1.0):
+        self.filename = filename
+        self.period = period
+        self.file = None
+        self.periodStart = None
+        self.counts = 0
+        self.livetime = 0.0
+
+    def open(self):
+        self.file = open(self.filename, "a", 1)
+
+    def append(self, timestamp, counts, livetime):
+        periodStart = math.floor(timestamp / self.period) * self.period
+        if self.periodStart != None and periodStart != self.periodStart:
+            self.write()
+        self.periodStart = periodStart
+        self.counts += counts
+        self.livetime += livetime
+
+    def write(self):
+        date = datetime.utcfromtimestamp(self.periodStart).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]+"Z"
+        rate = self.counts / self.livetime if self.livetime > 0 else 0.0
+        self.file.write("%s,%d,%0.3f,%0.3f\n" % (date, self.counts, self.livetime, rate))
+        self.counts = 0
+        self.livetime = 0.0
+
+    def close(self):
+        if self.file != None:
+            if self.periodStart != None:
+                self.write()
+            self.file.close()
+            self.file = None
@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright (C) 2014  Lionel Bergeret
+#
+# ----------------------------------------------------------------
+# The contents of this file are distributed under the CC0 license.
+# See http://creativecommons.org/publicdomain/zero/1.0/
+# ----------------------------------------------------------------
+import os
+import sys
+import time
+import copy
+import array
+import calendar
+import json
+import sqlite3
+import traceback
+from datetime import datetime, timedelta
+import jsonpickle
+
+dbSupport = False
+try:
+    from pymongo import MongoClient, errors
+    dbSupport = True
+except:
+    pass
+
+zulu_fmt = "%Y-%m-%dT%H:%M:%SZ"
+
+#
+# Interval record sinks
+#
+# Every closed logging interval produces one record, a dictionary with the
+# keys deviceid, date, realtime, livetime, channels (4096 counts), cpm and
+# counts. RadAngel.Process fans each record out to all the configured sinks,
+# and calls poll() about once a second so that sinks buffering records can
+# write them within a bounded delay even when no record comes.
+#
+class SpectrumSink(object):
+    def open(self):
+        pass
+    def write(self, record):
+        raise NotImplementedError('You must implement write() in %s' % self.__class__)
+    def writeMany(self, records):
+        for record in records:
+            self.write(record)
+    def poll(self):
+        pass
+    def flush(self):
+        pass
+    def close(self):
+        self.flush()
+
+#
+# Time bucket of a record date (start of the bucketSize seconds window, UTC)
+#
+def bucketStart(date, bucketSize):
+    epoch = calendar.timegm(date.utctimetuple())
+    return datetime.utcfromtimestamp(epoch - epoch % bucketSize)
+
+#
+# Bucket document size (MongoDB documents are limited to 16 MB)
+#
+# The sizes are BSON estimates, rounded up: the bucket itself with its 4096
+# channel totals, then each interval with its non zero channels.
+#
+BUCKET_MAX_SIZE = 12 * 1024 * 1024
+BUCKET_BASE_SIZE = 64 * 1024
+INTERVAL_BASE_SIZE = 160
+INTERVAL_CHANNEL_SIZE = 32
+
+def bucketIntervals(bucketSize, minInterval):
+    """Return the number of intervals of a bucket, None if they may not all fit in the size limit"""
+    intervals = int(bucketSize / minInterval) + 1
+    if BUCKET_BASE_SIZE + intervals * INTERVAL_BASE_SIZE > BUCKET_MAX_SIZE:
+        return None
+    return intervals
+
+#
+# MongoDB sink (records which could not be inserted are cached and retried)
+#
+# With bucketSize = 0 every record is a document in db.spectrum. Otherwise
+# records are appended to db.spectrum_bucket documents covering bucketSize
+# seconds each, holding the interval list plus the running channels, counts,
+# realtime and livetime totals of the bucket:
+#
+#   {deviceid, date (bucket start), end, nintervals, counts, realtime,
+#    livetime, channels: [4096], size, intervals: [{date, realtime,
+#    livetime, cpm, counts, channels: [{c: channel, n: count}, ...]}, ...]}
+#
+# The interval channels are sparse (non zero channels only), so short
+# intervals take a few hundred bytes. size is the estimated size of the
+# document: an interval which would take it over BUCKET_MAX_SIZE goes to
+# db.spectrum instead, where the range queries find it as well.
+#
+class MongoSink(SpectrumSink):
+    def __init__(self, config, deviceId):
+        self.config = config
+        self.deviceId = deviceId
+        self.bucketSize = config.bucketSize
+        self.cacheFilename = "cached_%s.json" % deviceId
+        self.connection = None
+        self.db = None
+        self.cachedData = []
+        self.uploadFailed = False
+
+    def logPrint(self, message):
+       print "[%s] %s" % (self.deviceId, message)
+
+    def connect(self):
+        self.connection = MongoClient(self.config.db_host, self.config.db_port, socketTimeoutMS=self.config.networkTimeout, connectTimeoutMS=self.config.networkTimeout)
+        self.db = self.connection[self.config.db_name]
+        # MongoLab has user authentication
+        self.db.authenticate(self.config.db_user, self.config.db_passwd)
+
+    def open(self):
+        self.connect()
+        if self.bucketSize > 0:
+            self.db.spectrum_bucket.ensure_index([("deviceid", 1), ("date", 1)], unique=True)
+
+        # Cached data
+        try:
+          cacheFile = open(self.cacheFilename,'r')
+          self.cachedData = list(jsonpickle.iterdecode(cacheFile))
+          cacheFile.close()
+          os.remove(self.cacheFilename)
+        except:
+          self.cachedData = []
+
+    def insert(self, records):
+        if self.bucketSize > 0:
+            for record in records:
+                self.appendToBucket(record)
+        else:
+            self.db.spectrum.insert(records)
+
+    def appendToBucket(self, record):
+        start = bucketStart(record["date"], self.bucketSize)
+        interval = dict((key, record[key]) for key in ("date", "realtime", "livetime", "cpm", "counts"))
+        interval["channels"] = [{"c": i, "n": count} for i, count in enumerate(record["channels"]) if count]
+        size = INTERVAL_BASE_SIZE + INTERVAL_CHANNEL_SIZE * len(interval["channels"])
+        increments = {"nintervals": 1, "counts": record["counts"], "realtime": record["realtime"], "livetime": record["livetime"],
+                      "size": size}
+        for i, count in enumerate(record["channels"]):
+            if count:
+                increments["channels.%d" % i] = count
+
+        # The interval date guard makes the append idempotent when cached records are replayed
+        # (buckets written before the size field was kept are never appended to)
+        result = self.db.spectrum_bucket.update({"deviceid": record["deviceid"], "date": start, "intervals.date": {"$ne": record["date"]},
+                                                 "size": {"$lte": BUCKET_MAX_SIZE - size}},
+                                                {"$inc": increments, "$push": {"intervals": interval}})
+        if result["n"] > 0:
+            return
+
+        # First interval of this bucket, or interval already stored, or bucket full
+        bucket = {"deviceid": record["deviceid"], "date": start, "end": start + timedelta(seconds = self.bucketSize),
+                  "nintervals": 1, "counts": record["counts"], "realtime": record["realtime"], "livetime": record["livetime"],
+                  "channels": list(record["channels"]), "size": BUCKET_BASE_SIZE + size, "intervals": [interval]}
+        try:
+            self.db.spectrum_bucket.insert(bucket)
+        except errors.DuplicateKeyError:
+            if self.db.spectrum_bucket.find_one({"deviceid": record["deviceid"], "date": start, "intervals.date": record["date"]}) != None:
+                return
+            # Bucket full, the interval is kept as a plain spectrum document
+            if self.db.spectrum.find_one({"deviceid": record["deviceid"], "date": record["date"]}) == None:
+                self.db.spectrum.insert(record)
+
+    def write(self, record):
+        self.cachedData.append(record)
+        self.upload()
+
+    def writeMany(self, records):
+        self.cachedData.extend(records)
+        self.upload()
+
+    def upload(self):
+        try:
+          if self.uploadFailed:
+            try:
+              # We failed previously so we need to reconnect
+              self.connect()
+            except:
+              self.logPrint("Database connection failed [%d item(s)]" % len(self.cachedData))
+              print '-'*60
+              traceback.print_exc(file=sys.stdout)
+              print '-'*60
+              pass
+
+          bulkDataInsert = copy.deepcopy(self.cachedData)
+          self.insert(bulkDataInsert)
+          self.logPrint("Database updated [%d item(s)]" % len(self.cachedData))
+          self.cachedData = []
+          self.uploadFailed = False
+        except:
+          # Keep cached data and retry later
+          self.logPrint("Failed to update database [%d item(s)]" % len(self.cachedData))
+          self.uploadFailed = True
+          if self.connection != None: self.connection.disconnect()
+          print '-'*60
+          traceback.print_exc(file=sys.stdout)
+          print '-'*60
+          pass
+
+    def close(self):
+        if len(self.cachedData):
+            # Dump data that couldn't make it to database for later insert
+            jsonpickle.set_encoder_options('simplejson', sort_keys=True)
+            cacheFile = open(self.cacheFilename, "w")
+            jsonpickle.encode_to(cacheFile, self.cachedData)
+            cacheFile.close()
+
+#
+# JSON lines file sink (one record per line, date in zulu format)
+#
+class FileSink(SpectrumSink):
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = None
+
+    def open(self):
+        self.file = open(self.filename, "a", 1)
+
+    def write(self, record):
+        data = dict(record)
+        data["date"] = record["date"].strftime(zulu_fmt)
+        self.file.write("%s\n" % json.dumps(data, sort_keys=True))
+
+    def flush(self):
+        if self.file != None: self.file.flush()
+
+    def close(self):
+        if self.file != None:
+            self.file.close()
+            self.file = None
+
+#
+# SQLite sink (local queryable history)
+#
+# Records are buffered and inserted in a single transaction once batchSize
+# records are pending or the oldest one waited more than maxDelay seconds
+# (checked on write and on poll).
+# The database runs in WAL mode so readers never block the capture.
+#
+class SQLiteSink(SpectrumSink):
+    def __init__(self, filename, batchSize = 16, maxDelay = 60.0):
+        self.filename = filename
+        self.batchSize = batchSize
+        self.maxDelay = maxDelay
+        self.connection = None
+        self.pending = []
+        self.pendingSince = 0.0
+
+    def open(self):
+        self.connection = sqlite3.connect(self.filename, check_same_thread = False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS spectrum (
+                                   id INTEGER PRIMARY KEY,
+                                   deviceid TEXT NOT NULL,
+                                   date TEXT NOT NULL,
+                                   realtime REAL,
+                                   livetime REAL,
+                                   cpm REAL,
+                                   counts INTEGER,
+                                   channels BLOB)""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS spectrum_deviceid_date ON spectrum (deviceid, date)")
+        self.connection.commit()
+
+    def write(self, record):
+        if not self.pending:
+            self.pendingSince = time.time()
+        self.pending.append((record["deviceid"], record["date"].strftime(zulu_fmt), record["realtime"], record["livetime"],
+                             record["cpm"], record["counts"], sqlite3.Binary(array.array("I", record["channels"]).tostring())))
+        if (len(self.pending) >= self.batchSize) or (time.time() - self.pendingSince >= self.maxDelay):
+            self.flush()
+
+    def poll(self):
+        if self.pending and (time.time() - self.pendingSince >= self.maxDelay):
+            self.flush()
+
+    def flush(self):
+        if not self.pending or self.connection == None:
+            return
+        with self.connection:
+            self.connection.executemany("INSERT INTO spectrum (deviceid, date, realtime, livetime, cpm, counts, channels) VALUES (?, ?, ?, ?, ?, ?, ?)", self.pending)
+        self.pending = []
+
+    def records(self, deviceId, start = None, end = None):
+        """Yield the stored records of a device between start and end (datetime, inclusive)"""
+        query = "SELECT deviceid, date, realtime, livetime, cpm, counts, channels FROM spectrum WHERE deviceid = ?"
+        args = [deviceId]
+        if start != None:
+            query += " AND date >= ?"
+            args.append(start.strftime(zulu_fmt))
+        if end != None:
+            query += " AND date <= ?"
+            args.append(end.strftime(zulu_fmt))
+        query += " ORDER BY date"
+        for row in self.connection.execute(query, args):
+            channels = array.array("I")
+            channels.fromstring(str(row[6]))
+            yield {"deviceid": row[0], "date": datetime.strptime(row[1], zulu_fmt), "realtime": row[2], "livetime": row[3],
+                   "cpm": row[4], "counts": row[5], "channels": channels.tolist()}
+
+    def close(self):
+        if self.connection != None:
+            self.flush()
+            self.connection.close()
+            self.connection = None
+
+#
+# Build the sinks from configuration
+#
+def createSinks(config, deviceId, useDatabase):
+    sinks = []
+    if useDatabase and dbSupport:
+        sinks.append(MongoSink(config, deviceId))
+    if config.sqliteFilename:
+        sinks.append(SQLiteSink(config.sqliteFilename, config.sqliteBatch))
+    if config.recordsFilename:
+        sinks.append(FileSink(config.recordsFilename))
+    if config.aggregatorAddress:
+        from radangel_transport import NetworkSink
+        sinks.append(NetworkSink(config.aggregatorAddress, deviceId, config.aggregatorBatch, config.networkTimeout / 1000.0))
+    return sinks
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright (C) 2014  Lionel Bergeret
+#
+# ----------------------------------------------------------------
+# The contents of this file are distributed under the CC0 license.
+# See http://creativecommons.org/publicdomain/zero/1.0/
+# ----------------------------------------------------------------
+import os
+import sys
+import mmap
+import glob
+import time
+import array
+import operator
+import multiprocessing
+from optparse import OptionParser
+
+# Energy calibration written by export2SPE (from multispec tool for RadAngel)
+KROMEK_ENERGY_FIT = (-357.199955175409, 0.969844070381318)
+
+NB_CHANNELS = 4096
+
+#
+# SPE file reader
+#
+# Reads the sections written by export2SPE and by most MCA software:
+#   $SPEC_REM  free text remarks (export2SPE writes timestamp,device_ID,...)
+#   $MEAS_TIM  realtime and livetime (as "livetime realtime" in the ORTEC
+#              convention, export2SPE writes them the other way round, so
+#              the larger value is taken as the realtime)
+#   $DATA      first and last channel, then one count per line
+#   $ENER_FIT  energy calibration offset and slope (keV = a + b x channel)
+#
+# The file is memory mapped and each section is located with find() and
+# converted in one go, the counts going straight into an array of doubles
+# (exact for any realistic count, and summed without overflow).
+#
+class SPESpectrum():
+    def __init__(self):
+        self.channels = array.array("d")
+        self.realtime = 0.0
+        self.livetime = 0.0
+        self.energyFit = None
+        self.remarks = []
+        self.timestamp = None
+        self.deviceId = None
+
+    def energy(self, channel):
+        a, b = self.energyFit or KROMEK_ENERGY_FIT
+        return a + b * channel
+
+def speSection(data, name):
+    """Return the text of the $name: section (None if missing)"""
+    start = data.find("$%s:" % name)
+    if start < 0:
+        return None
+    start = data.find("\n", start)
+    if start < 0:
+        return ""
+    end = data.find("$", start)
+    if end < 0:
+        end = len(data)
+    return data[start + 1:end]
+
+def parseSPE(data):
+    spectrum = SPESpectrum()
+
+    section = speSection(data, "SPEC_REM")
+    if section:
+        spectrum.remarks = [line.strip() for line in section.splitlines() if line.strip()]
+
+    section = speSection(data, "MEAS_TIM")
+    if section:
+        times = [float(x) for x in section.split()[:2]]
+        spectrum.realtime, spectrum.livetime = max(times), min(times)
+
+    section = speSection(data, "DATA")
+    if section:
+        values = section.split()
+        first, last = int(values[0]), int(values[1])
+        spectrum.channels = array.array("d", [0.0]) * first
+        spectrum.channels.extend(map(float, values[2:2 + last - first + 1]))
+
+    section = speSection(data, "ENER_FIT")
+    if section:
+        spectrum.energyFit = tuple(float(x) for x in section.split()[:2])
+
+    # The export2SPE remark holds the device id and the timing with millisecond precision
+    for remark in spectrum.remarks:
+        fields = remark.split(",")
+        if len(fields) == 5 and not remark.startswith("#"):
+            try:
+              spectrum.realtime, spectrum.livetime = float(fields[2]), float(fields[3])
+              spectrum.timestamp, spectrum.deviceId = fields[0], fields[1]
+            except ValueError:
+              pass
+    return spectrum
+
+def readSPE(filename):
+    speFile = open(filename, "rb")
+    try:
+        try:
+          data = mmap.mmap(speFile.fileno(), 0, access = mmap.ACCESS_READ)
+        except (mmap.error, ValueError):
+          # Empty file or no mmap support (pipe...)
+          return parseSPE(speFile.read())
+        try:
+            return parseSPE(data)
+        finally:
+            data.close()
+    finally:
+        speFile.close()
+
+#
+# Bulk merge
+#
+# The files are split in chunks summed by a pool of worker processes, each
+# returning its partial sum (channels, realtime, livetime, files, device ids).
+#
+def addChannels(channels, values):
+    if len(values) > len(channels):
+        channels.extend(array.array("d", [0.0]) * (len(values) - len(channels)))
+    channels[:len(values)] = array.array("d", map(operator.add, channels[:len(values)], values))
+
+def sumSPE(filenames):
+    channels = array.array("d", [0.0]) * NB_CHANNELS
+    realtime = 0.0
+    livetime = 0.0
+    deviceIds = set()
+    for filename in filenames:
+        spectrum = readSPE(filename)
+        addChannels(channels, spectrum.channels)
+        realtime += spectrum.realtime
+        livetime += spectrum.livetime
+        deviceIds.add(spectrum.deviceId)
+    return channels, realtime, livetime, len(filenames), deviceIds
+
+def mergeSPE(filenames, jobs = None, chunkSize = 256):
+    """Sum the spectra and times of the SPE files, in parallel when jobs > 1"""
+    chunks = [filenames[i:i + chunkSize] for i in range(0, len(filenames), chunkSize)]
+    if jobs == None:
+        jobs = multiprocessing.cpu_count()
+    if jobs > 1 and len(chunks) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(chunks)))
+        try:
+            partials = pool.map(sumSPE, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        partials = [sumSPE(chunk) for chunk in chunks]
+
+    channels = array.array("d", [0.0]) * NB_CHANNELS
+    realtime = 0.0
+    livetime = 0.0
+    deviceIds = set()
+    for partialChannels, partialRealtime, partialLivetime, count, partialDeviceIds in partials:
+        addChannels(channels, partialChannels)
+        realtime += partialRealtime
+        livetime += partialLivetime
+        deviceIds |= partialDeviceIds
+    return channels, realtime, livetime, deviceIds
+
+# -----------------------------------------------------------------------------
+# Main
+# -----------------------------------------------------------------------------
+if __name__ == '__main__':
+  from radangel import export2SPE
+
+  # Process command line options
+  parser = OptionParser("Usage: radangel_spe.py [options] <spefile|directory> [...]")
+
+  parser.add_option("-o", "--output",
+                      type=str, dest="output", default=None,
+                      help="merge the spectra into this SPE file (default print a summary of each file)")
+  parser.add_option("-j", "--jobs",
+                      type=int, dest="jobs", default=None,
+                      help="specify the number of merge processes (default number of CPUs)")
+  parser.add_option("-i", "--deviceid",
+                      type=str, dest="deviceid", default=None,
+                      help="specify the device id of the merged spectrum (default from the files)")
+
+  (options, args) = parser.parse_args()
+
+  if len(args) == 0:
+    parser.print_help()
+    sys.exit(0)
+
+  filenames = []
+  for arg in args:
+    if os.path.isdir(arg):
+      filenames.extend(sorted(glob.glob(os.path.join(arg, "*.spe"))))
+    else:
+      filenames.extend(sorted(glob.glob(arg)) or [arg])
+
+  if options.output == None:
+    for filename in filenames:
+      spectrum = readSPE(filename)
+      print "%s: device = %s, realtime = %0.3f, livetime = %0.3f, total count = %d" % (filename, spectrum.deviceId,
+            spectrum.realtime, spectrum.livetime, sum(spectrum.channels))
+    sys.exit(0)
+
+  start_time = time.time()
+  channels, realtime, livetime, deviceIds = mergeSPE(filenames, options.jobs)
+  deviceId = options.deviceid
+  if deviceId == None:
+    deviceIds.discard(None)
+    deviceId = deviceIds.pop() if len(deviceIds) == 1 else "merged"
+  export2SPE(options.output, deviceId, channels, realtime, livetime)
+  print "%d file(s) merged into %s in %0.3f seconds (realtime = %0.3f, livetime = %0.3f, total count = %d)" % (len(filenames),
+        options.output, time.time() - start_time, realtime, livetime, sum(channels))
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright (C) 2014  Lionel Bergeret
+#
+# ----------------------------------------------------------------
+# The contents of this file are distributed under the CC0 license.
+# See http://creativecommons.org/publicdomain/zero/1.0/
+# ----------------------------------------------------------------
+import os
+import mmap
+import time
+import zlib
+import array
+import struct
+
+NB_CHANNELS = 4096
+
+#
+# Capture state checkpoint file
+#
+# The file is memory mapped and holds two slots written alternately, so a
+# crash in the middle of a checkpoint always leaves the previous one intact.
+# Each slot is:
+#
+#   header  magic, version, sequence, device id, interval sequence,
+#           total counter, realtime, livetime, previous realtime/livetime
+#           (start of the current logging interval), elapsed time of the
+#           current logging interval, checkpoint timestamp
+#   counts  current (partial) interval histogram, NB_CHANNELS x uint32
+#   totals  cumulated histogram since start, NB_CHANNELS x double
+#   crc     crc32 of all the above
+#
+STATE_MAGIC = "RAST"
+STATE_VERSION = 1
+STATE_HEADER = struct.Struct("<4sIQ32sQQdddddd")
+STATE_CRC = struct.Struct("<I")
+
+COUNTS_TYPECODE = "I"
+TOTALS_TYPECODE = "d"
+assert array.array(COUNTS_TYPECODE).itemsize == 4
+
+COUNTS_OFFSET = STATE_HEADER.size
+TOTALS_OFFSET = COUNTS_OFFSET + NB_CHANNELS * 4
+CRC_OFFSET = TOTALS_OFFSET + NB_CHANNELS * 8
+SLOT_SIZE = CRC_OFFSET + STATE_CRC.size
+
+class CaptureState():
+    def __init__(self):
+        self.sequence = 0
+        self.deviceId = ""
+        self.intervalSequence = 0
+        self.totalcounter = 0
+        self.realtime = 0.0
+        self.livetime = 0.0
+        self.previousRealtime = 0.0
+        self.previousLivetime = 0.0
+        self.intervalElapsed = 0.0
+        self.timestamp = 0.0
+        self.counts = {}
+        self.channelsTotal = [0 for i in range(NB_CHANNELS)]
+
+class CaptureCheckpoint():
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = None
+        self.map = None
+        self.sequence = 0
+
+    def open(self):
+        exists = os.path.exists(self.filename)
+        self.file = open(self.filename, "r+b" if exists else "w+b")
+        if os.path.getsize(self.filename) != 2 * SLOT_SIZE:
+            self.file.truncate(2 * SLOT_SIZE)
+        self.map = mmap.mmap(self.file.fileno(), 2 * SLOT_SIZE)
+        # Continue after the newest slot, whatever its device id, so the next
+        # save always supersedes what is already in the file
+        for slot in (0, 1):
+            state = self.readSlot(slot)
+            if state != None and state.sequence > self.sequence:
+                self.sequence = state.sequence
+
+    def reset(self):
+        """Invalidate both slots (fresh capture)"""
+        self.map[0:2 * SLOT_SIZE] = "\0" * (2 * SLOT_SIZE)
+        self.map.flush()
+        self.sequence = 0
+
+    def close(self):
+        if self.map != None:
+            self.map.flush()
+            self.map.close()
+            self.map = None
+        if self.file != None:
+            self.file.close()
+            self.file = None
+
+    def remove(self):
+        self.close()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def readSlot(self, slot):
+        base = slot * SLOT_SIZE
+        data = self.map[base:base + SLOT_SIZE]
+        (crc,) = STATE_CRC.unpack_from(data, CRC_OFFSET)
+        if zlib.crc32(data[:CRC_OFFSET]) & 0xffffffff != crc:
+            return None
+        header = STATE_HEADER.unpack_from(data, 0)
+        if header[0] != STATE_MAGIC or header[1] != STATE_VERSION:
+            return None
+
+        state = CaptureState()
+        (state.sequence, deviceId, state.intervalSequence, state.totalcounter, state.realtime, state.livetime,
+         state.previousRealtime, state.previousLivetime, state.intervalElapsed, state.timestamp) = header[2:]
+        state.deviceId = deviceId.rstrip("\0")
+
+        counts = array.array(COUNTS_TYPECODE)
+        counts.fromstring(data[COUNTS_OFFSET:TOTALS_OFFSET])
+        state.counts = dict((i, c) for i, c in enumerate(counts) if c)
+        totals = array.array(TOTALS_TYPECODE)
+        totals.fromstring(data[TOTALS_OFFSET:CRC_OFFSET])
+        state.channelsTotal = [int(c) for c in totals]
+        return state
+
+    def load(self, deviceId):
+        """Return the latest valid checkpoint of deviceId (or None)"""
+        latest = None
+        for slot in (0, 1):
+            state = self.readSlot(slot)
+            if state == None or state.deviceId != deviceId:
+                continue
+            if latest == None or state.sequence > latest.sequence:
+                latest = state
+        if latest != None:
+            self.sequence = latest.sequence
+        return latest
+
+    def save(self, deviceId, intervalSequence, totalcounter, realtime, livetime, previousRealtime, previousLivetime,
+             intervalElapsed, counts, channelsTotal):
+        self.sequence += 1
+        base = (self.sequence % 2) * SLOT_SIZE
+
+        # Interval histogram is sparse, only touch the non zero channels
+        countsArray = array.array(COUNTS_TYPECODE, [0]) * NB_CHANNELS
+        for channel, count in counts.iteritems():
+            countsArray[channel] = count
+
+        header = STATE_HEADER.pack(STATE_MAGIC, STATE_VERSION, self.sequence, deviceId, intervalSequence, totalcounter,
+                                   realtime, livetime, previousRealtime, previousLivetime, intervalElapsed, time.time())
+        data = header + countsArray.tostring() + array.array(TOTALS_TYPECODE, channelsTotal).tostring()
+        self.map[base:base + CRC_OFFSET] = data
+        STATE_CRC.pack_into(self.map, base + CRC_OFFSET, zlib.crc32(data) & 0xffffffff)
+        self.map.flush()
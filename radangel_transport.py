@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# Copyright (C) 2014  Lionel Bergeret
+#
+# ----------------------------------------------------------------
+# The contents of this file are distributed under the CC0 license.
+# See http://creativecommons.org/publicdomain/zero/1.0/
+# ----------------------------------------------------------------
+import os
+import sys
+import time
+import json
+import zlib
+import signal
+import socket
+import struct
+import threading
+import traceback
+import SocketServer
+import Queue
+from collections import deque
+from datetime import datetime
+from optparse import OptionParser
+import jsonpickle
+
+from radangel_sinks import SpectrumSink
+
+zulu_fmt = "%Y-%m-%dT%H:%M:%SZ"
+# Records are sent with microseconds so that the intervals closed within the same
+# second (short intervals, control snapshots) stay distinct for the deduplication
+wire_fmt = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+# Frame = 4 bytes big endian payload length + zlib compressed JSON list of records,
+# acknowledged by the aggregator with a single ACK byte once written to its sinks
+FRAME_HEADER = struct.Struct("!I")
+FRAME_MAX_SIZE = 64 * 1024 * 1024
+ACK = "K"
+
+#
+# Address helpers ("unix:/path/to/socket" or "host:port")
+#
+def parseAddress(address):
+    if address.startswith("unix:"):
+        return socket.AF_UNIX, address[5:]
+    host, port = address.rsplit(":", 1)
+    return socket.AF_INET, (host, int(port))
+
+def connect(address, timeout):
+    family, target = parseAddress(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    sock.connect(target)
+    return sock
+
+#
+# Framing
+#
+def encodeBatch(records):
+    batch = []
+    for record in records:
+        data = dict(record)
+        data["date"] = record["date"].strftime(wire_fmt)
+        batch.append(data)
+    payload = zlib.compress(json.dumps(batch, separators=(",", ":")))
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+def decodeBatch(payload):
+    batch = json.loads(zlib.decompress(payload))
+    for record in batch:
+        # Nodes running an older version send whole seconds
+        date = record["date"]
+        record["date"] = datetime.strptime(date, wire_fmt if "." in date else zulu_fmt)
+    return batch
+
+def recvExactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(size)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return "".join(chunks)
+
+def recvFrame(sock):
+    header = recvExactly(sock, FRAME_HEADER.size)
+    if header == None:
+        return None
+    (size,) = FRAME_HEADER.unpack(header)
+    if size > FRAME_MAX_SIZE:
+        raise IOError("Frame too large (%d bytes)" % size)
+    return recvExactly(sock, size)
+
+#
+# Capture node side: sink streaming records to the aggregator
+#
+# Records are sent in frames of at most batchSize records over a persistent
+# connection, each frame being dropped from the pending records once it is
+# acknowledged. A frame which is not acknowledged stays pending and is resent
+# later (the aggregator drops duplicates). During long aggregator outages at
+# most maxPending records are kept in memory, the older ones are spilled to the
+# spill_<deviceid>.jsonl file (one jsonpickle record per line) and replayed,
+# replayBatches frames per flush, once the aggregator is back. Pending records
+# survive restarts in the same file; the replay position does not, so a
+# restart may resend spilled records already acknowledged.
+#
+class NetworkSink(SpectrumSink):
+    def __init__(self, address, deviceId, batchSize = 1, timeout = 5.0, retryDelay = 30.0, maxPending = 512,
+                 replayBatches = 16):
+        self.address = address
+        self.deviceId = deviceId
+        self.batchSize = batchSize
+        self.timeout = timeout
+        self.retryDelay = retryDelay
+        self.maxPending = max(maxPending, batchSize)
+        self.replayBatches = replayBatches
+        self.pendingFilename = "pending_%s.json" % deviceId # written by older versions
+        self.spillFilename = "spill_%s.jsonl" % deviceId
+        self.spillOffset = 0 # position of the first spilled record not acknowledged
+        self.sock = None
+        self.pending = []
+        self.lastFailure = 0.0
+
+    def logPrint(self, message):
+       print "[%s] %s" % (self.deviceId, message)
+
+    def open(self):
+        try:
+          pendingFile = open(self.pendingFilename,'r')
+          self.spill(jsonpickle.iterdecode(pendingFile))
+          pendingFile.close()
+          os.remove(self.pendingFilename)
+        except:
+          pass
+
+    def write(self, record):
+        self.pending.append(record)
+        if len(self.pending) > self.maxPending:
+            # Keep the memory bounded, the oldest records wait on disk
+            self.spill(self.pending[:-self.maxPending])
+            del self.pending[:-self.maxPending]
+        if len(self.pending) >= self.batchSize:
+            self.flush()
+
+    def spill(self, records):
+        spillFile = open(self.spillFilename, "a")
+        for record in records:
+            spillFile.write("%s\n" % jsonpickle.encode(record))
+        spillFile.close()
+
+    def disconnect(self):
+        if self.sock != None:
+            try:
+              self.sock.close()
+            except:
+              pass
+            self.sock = None
+
+    def send(self, records):
+        self.sock.sendall(encodeBatch(records))
+        if recvExactly(self.sock, 1) != ACK:
+            raise IOError("Aggregator did not acknowledge")
+
+    def replaySpill(self):
+        """Send up to replayBatches frames of spilled records, remove the file once all are sent"""
+        spillFile = open(self.spillFilename, "r")
+        try:
+          spillFile.seek(self.spillOffset)
+          for i in range(self.replayBatches):
+              batch = []
+              while len(batch) < self.batchSize:
+                  line = spillFile.readline()
+                  if not line.endswith("\n"):
+                      # End of file (or last line cut by a crash)
+                      break
+                  if line.strip():
+                      batch.append(jsonpickle.decode(line))
+              if batch:
+                  self.send(batch)
+                  self.spillOffset = spillFile.tell()
+              if len(batch) < self.batchSize:
+                  spillFile.close()
+                  os.remove(self.spillFilename)
+                  self.spillOffset = 0
+                  return
+        finally:
+          spillFile.close()
+
+    def flush(self):
+        spilled = os.path.exists(self.spillFilename)
+        if not self.pending and not spilled:
+            return
+        # Avoid reconnect storms when the aggregator is down
+        if self.sock == None and time.time() - self.lastFailure < self.retryDelay:
+            return
+        try:
+          if self.sock == None:
+              self.sock = connect(self.address, self.timeout)
+          while self.pending:
+              batch = self.pending[:self.batchSize]
+              self.send(batch)
+              del self.pending[:len(batch)]
+          if spilled:
+              self.replaySpill()
+        except:
+          self.logPrint("Failed to send to aggregator %s [%d item(s)%s]" % (self.address, len(self.pending),
+                        " + spilled" if spilled else ""))
+          self.lastFailure = time.time()
+          self.disconnect()
+
+    def close(self):
+        self.lastFailure = 0.0
+        self.flush()
+        self.disconnect()
+        if len(self.pending):
+            # Keep data that couldn't make it to the aggregator for later retry
+            self.spill(self.pending)
+            self.pending = []
+
+#
+# Aggregator side
+#
+class AggregatorHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        while True:
+            try:
+              payload = recvFrame(self.request)
+            except:
+              return
+            if payload == None:
+                return
+            batch = QueuedBatch(decodeBatch(payload))
+            self.server.aggregator.put(batch)
+            batch.done.wait()
+            if not batch.written:
+                # No ACK, the node keeps the records and sends them again
+                return
+            self.request.sendall(ACK)
+
+class ThreadingTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class ThreadingUnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+class QueuedBatch():
+    def __init__(self, records):
+        self.records = records
+        self.done = threading.Event()
+        self.written = False
+
+#
+# Aggregator daemon: receives record batches from the capture nodes, drops
+# duplicates (same deviceid and date) and writes them to the sinks
+#
+# A node batch is only acknowledged once it is written, so the writer does not
+# wait to fill its batches: it writes whatever the nodes queued meanwhile (up to
+# batchSize records) in one go, which batches more as the load increases.
+#
+class Aggregator():
+    def __init__(self, address, sinks, batchSize = 64, dedupSize = 100000):
+        self.address = address
+        self.sinks = sinks
+        self.batchSize = batchSize
+        self.queue = Queue.Queue()
+        self.seen = set()
+        self.seenOrder = deque()
+        self.dedupSize = dedupSize
+        self.server = None
+        self.writer = None
+        self.Terminated = False
+        self.received = 0
+        self.duplicates = 0
+        self.written = 0
+
+    def put(self, batch):
+        self.queue.put(batch)
+
+    def isDuplicate(self, record):
+        key = (record["deviceid"], record["date"])
+        if key in self.seen:
+            return True
+        self.seen.add(key)
+        self.seenOrder.append(key)
+        if len(self.seenOrder) > self.dedupSize:
+            self.seen.discard(self.seenOrder.popleft())
+        return False
+
+    def writeBatch(self, batch):
+        """Write the records to all the sinks, return False if one failed"""
+        written = True
+        for sink in self.sinks:
+            try:
+              sink.writeMany(batch)
+              sink.flush()
+            except:
+              print '-'*60
+              traceback.print_exc(file=sys.stdout)
+              print '-'*60
+              written = False
+        if written:
+            self.written += len(batch)
+        else:
+            # The nodes resend them, do not drop them as duplicates then
+            for record in batch:
+                self.seen.discard((record["deviceid"], record["date"]))
+        return written
+
+    def writeLoop(self):
+        while not (self.Terminated and self.queue.empty()):
+            try:
+              queued = [self.queue.get(timeout = 0.5)]
+            except Queue.Empty:
+              continue
+            batch = []
+            while True:
+                for record in queued[-1].records:
+                    self.received += 1
+                    if self.isDuplicate(record):
+                        self.duplicates += 1
+                    else:
+                        batch.append(record)
+                if len(batch) >= self.batchSize:
+                    break
+                try:
+                  queued.append(self.queue.get_nowait())
+                except Queue.Empty:
+                  break
+            written = self.writeBatch(batch) if batch else True
+            for queuedBatch in queued:
+                queuedBatch.written = written
+                queuedBatch.done.set()
+
+    def start(self):
+        for sink in self.sinks:
+            sink.open()
+        family, target = parseAddress(self.address)
+        if family == socket.AF_UNIX:
+            if os.path.exists(target):
+                os.remove(target)
+            self.server = ThreadingUnixServer(target, AggregatorHandler)
+        else:
+            self.server = ThreadingTCPServer(target, AggregatorHandler)
+        self.server.aggregator = self
+        self.writer = threading.Thread(target = self.writeLoop)
+        self.writer.start()
+        serverThread = threading.Thread(target = self.server.serve_forever)
+        serverThread.daemon = True
+        serverThread.start()
+
+    def stop(self):
+        self.Terminated = True
+        if self.server != None:
+            self.server.shutdown()
+            self.server.server_close()
+        if self.writer != None:
+            self.writer.join()
+        for sink in self.sinks:
+            sink.close()
+
+# -----------------------------------------------------------------------------
+# Main
+# -----------------------------------------------------------------------------
+if __name__ == '__main__':
+  from radangel import RadAngelConfiguration
+  from radangel_sinks import createSinks, dbSupport
+
+  # Process command line options
+  parser = OptionParser("Usage: radangel_transport.py [options]")
+
+  parser.add_option("-d", "--database",
+                      action="store_true", dest="database", default=False,
+                      help="upload to mongodb database")
+  parser.add_option("-l", "--listen",
+                      type=str, dest="listen", default=None,
+                      help="specify the listen address (unix:/path or host:port, default aggregator from configuration)")
+
+  (options, args) = parser.parse_args()
+
+  config = RadAngelConfiguration(".radangel.conf")
+  address = options.listen or config.aggregatorAddress
+  if address == None:
+    print "No aggregator address to listen on"
+    sys.exit(1)
+
+  # The aggregator writes to the configured sinks, never back to another aggregator
+  config.aggregatorAddress = None
+  aggregator = Aggregator(address, createSinks(config, "aggregator", options.database & dbSupport))
+  aggregator.start()
+  print "Aggregator listening on %s" % address
+
+  # Stop cleanly when run as a service
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+  try:
+    while True:
+      time.sleep(1.0)
+  except KeyboardInterrupt:
+    pass
+  finally:
+    aggregator.stop()
+    print "%d record(s) received, %d duplicate(s), %d written" % (aggregator.received, aggregator.duplicates, aggregator.written)
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+#
+# Regression tests of the vendored jsonpickle, run from the repository
+# root with python -m unittest discover tests (or pytest).
+#
+import array
+import unittest
+
+import jsonpickle
+from jsonpickle._samples import Thing
+
+
+class CycleTestCase(unittest.TestCase):
+    """Containers reaching themselves without a reference"""
+
+    def test_dict_cycle(self):
+        d = {}
+        d['self'] = d
+        self.assertEqual(jsonpickle.decode(jsonpickle.encode(d)),
+                         {'self': repr(d)})
+
+    def test_list_cycle_not_unpicklable(self):
+        l = [1]
+        l.append(l)
+        self.assertEqual(jsonpickle.decode(jsonpickle.encode(l, unpicklable=False)),
+                         [1, repr(l)])
+
+    def test_list_cycle_reference(self):
+        l = [1]
+        l.append(l)
+        restored = jsonpickle.decode(jsonpickle.encode(l))
+        self.assertTrue(restored[1] is restored)
+
+    def test_cycle_through_object(self):
+        o = Thing('o')
+        d = {'o': o}
+        o.d = d
+        restored = jsonpickle.decode(jsonpickle.encode(d))
+        # dicts get no py/id, the object's does
+        self.assertTrue(restored['o'].d['o'] is restored['o'])
+        self.assertEqual(restored['o'].name, 'o')
+
+    def test_shared_list_not_a_cycle(self):
+        x = [1, [2]]
+        self.assertEqual(jsonpickle.encode([x, x, {'a': x}], unpicklable=False),
+                         '[[1, [2]], [1, [2]], {"a": [1, [2]]}]')
+
+
+class BufferTestCase(unittest.TestCase):
+    """bytearray and array.array handlers"""
+
+    def test_roundtrip(self):
+        for value in (bytearray(b'ab\0'), array.array('d', [1.5, -2.0]),
+                      array.array('i', [1, 2, 3])):
+            restored = jsonpickle.decode(jsonpickle.encode(value))
+            self.assertEqual(type(restored), type(value))
+            self.assertEqual(restored, value)
+
+    def test_not_unpicklable(self):
+        self.assertEqual(jsonpickle.encode(bytearray(b'ab'), unpicklable=False),
+                         '[97, 98]')
+        self.assertEqual(jsonpickle.encode(array.array('d', [1.5, 2.0]),
+                                           unpicklable=False),
+                         '[1.5, 2.0]')
+
+    def test_legacy_bytearray(self):
+        restored = jsonpickle.decode(
+            '{"py/object": "__builtin__.bytearray", "py/seq": [97, 98]}')
+        self.assertEqual(restored, bytearray(b'ab'))
+
+    def test_legacy_array(self):
+        restored = jsonpickle.decode(
+            '{"py/object": "array.array", "py/seq": [1.5, 2.0]}')
+        self.assertEqual(restored, array.array('d', [1.5, 2.0]))
+        restored = jsonpickle.decode(
+            '{"py/object": "array.array", "py/seq": [1, 2]}')
+        self.assertEqual(restored, array.array('l', [1, 2]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+#
+# hidraw backend tests: a SOCK_SEQPACKET socket pair stands for the device
+# node, each send being read back as one report like /dev/hidrawN does
+#
+import os
+import sys
+import socket
+import unittest
+
+if sys.version_info[0] > 2:
+    raise unittest.SkipTest("radangel runs on Python 2")
+
+from radangel_hidraw import HidrawDevice
+
+REPORT_SIZE = 64
+
+
+def report(i):
+    return bytearray([i] * REPORT_SIZE)
+
+
+class HidrawDeviceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.node, self.device = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.hidraw = HidrawDevice(0x04d8, 0x0003)
+        # The device closes its descriptor
+        self.hidraw.open_fd(os.dup(self.device.fileno()))
+        self.device.close()
+
+    def tearDown(self):
+        self.hidraw.close()
+        self.node.close()
+
+    def test_timeout(self):
+        self.assertEqual(self.hidraw.readReports(REPORT_SIZE, 10), [])
+        self.assertEqual(self.hidraw.read(REPORT_SIZE, 10), [])
+
+    def test_report_framing(self):
+        for i in range(5):
+            self.node.send(str(report(i)))
+        self.node.send(str(bytearray([9] * 8))) # short report
+        reports = self.hidraw.readReports(REPORT_SIZE, 100)
+        self.assertEqual(reports, [report(i) for i in range(5)] + [bytearray([9] * 8)])
+        self.assertEqual(self.hidraw.readReports(REPORT_SIZE, 0), [])
+
+    def test_read_order(self):
+        for i in range(3):
+            self.node.send(str(report(i)))
+        for i in range(3):
+            self.assertEqual(self.hidraw.read(REPORT_SIZE, 100), list(report(i)))
+        self.assertEqual(self.hidraw.read(REPORT_SIZE, 0), [])
+
+        # Reports arriving while earlier ones are still pending keep their order
+        self.node.send(str(report(3)))
+        self.node.send(str(report(4)))
+        self.assertEqual(self.hidraw.read(REPORT_SIZE, 100), list(report(3)))
+        self.node.send(str(report(5)))
+        self.assertEqual(self.hidraw.read(REPORT_SIZE, 100), list(report(4)))
+        self.assertEqual(self.hidraw.read(REPORT_SIZE, 100), list(report(5)))
+
+    def test_disconnect(self):
+        self.node.send(str(report(1)))
+        self.node.close()
+        self.assertRaises(IOError, self.hidraw.readReports, REPORT_SIZE, 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+#
+# Range query tests against an in memory stand-in for the Mongo collections
+# (only the operators used by radangel_query are implemented).
+#
+import sys
+import unittest
+from datetime import datetime, timedelta
+
+if sys.version_info[0] > 2:
+    raise unittest.SkipTest("radangel runs on Python 2")
+
+from radangel_query import ensureIndexes, rangeSpectrum
+
+NB_CHANNELS = 8
+
+_missing = object()
+
+
+def lookup(doc, path):
+    for key in path.split("."):
+        if not isinstance(doc, dict) or key not in doc:
+            return _missing
+        doc = doc[key]
+    return doc
+
+
+def evaluate(doc, expression):
+    if isinstance(expression, basestring) and expression.startswith("$"):
+        value = lookup(doc, expression[1:])
+        return None if value is _missing else value
+    if isinstance(expression, dict) and "$ifNull" in expression:
+        value, default = [evaluate(doc, e) for e in expression["$ifNull"]]
+        return default if value is None else value
+    return expression
+
+
+def matches(doc, query):
+    for key, condition in query.items():
+        if key == "$or":
+            if not any(matches(doc, q) for q in condition):
+                return False
+            continue
+        value = lookup(doc, key)
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        for op, operand in condition.items():
+            if value is _missing:
+                if op != "$ne":
+                    return False
+            elif not {"$eq": value == operand, "$ne": value != operand,
+                      "$gt": value > operand, "$gte": value >= operand,
+                      "$lt": value < operand, "$lte": value <= operand}[op]:
+                return False
+    return True
+
+
+class FakeCollection(object):
+
+    def __init__(self):
+        self.documents = []
+        self.indexes = []
+
+    def ensure_index(self, keys, unique=False):
+        self.indexes.append((keys, unique))
+
+    def aggregate(self, pipeline):
+        docs = [dict(doc) for doc in self.documents]
+        for stage in pipeline:
+            (name, spec), = stage.items()
+            if name == "$match":
+                docs = [doc for doc in docs if matches(doc, spec)]
+            elif name == "$project":
+                docs = [dict((key, lookup(doc, key) if value == 1 else evaluate(doc, value))
+                             for key, value in spec.items()) for doc in docs]
+            elif name == "$unwind":
+                if isinstance(spec, basestring):
+                    spec = {"path": spec}
+                field = spec["path"][1:]
+                unwound = []
+                for doc in docs:
+                    for i, item in enumerate(doc[field]):
+                        doc = dict(doc)
+                        doc[field] = item
+                        if "includeArrayIndex" in spec:
+                            doc[spec["includeArrayIndex"]] = i
+                        unwound.append(doc)
+                docs = unwound
+            elif name == "$group":
+                groups = {}
+                for doc in docs:
+                    key = evaluate(doc, spec["_id"])
+                    group = groups.setdefault(key, dict((field, 0) for field in spec if field != "_id"))
+                    for field, accumulator in spec.items():
+                        if field != "_id":
+                            group[field] += evaluate(doc, accumulator["$sum"])
+                docs = []
+                for key, group in groups.items():
+                    group["_id"] = key
+                    docs.append(group)
+            else:
+                raise NotImplementedError(name)
+        return iter(docs)
+
+
+class FakeDatabase(object):
+
+    def __init__(self):
+        self.spectrum = FakeCollection()
+        self.spectrum_bucket = FakeCollection()
+
+
+def interval(date, channels, sparse=True):
+    doc = {"date": date, "realtime": 60.0, "livetime": 59.0, "counts": sum(channels), "cpm": sum(channels)}
+    if sparse:
+        doc["channels"] = [{"c": i, "n": n} for i, n in enumerate(channels) if n]
+    else:
+        doc["channels"] = list(channels)
+    return doc
+
+
+def bucket(start, intervals, deviceId="000000-000000"):
+    channels = [0] * NB_CHANNELS
+    for doc in intervals:
+        if doc["channels"] and isinstance(doc["channels"][0], dict):
+            for entry in doc["channels"]:
+                channels[entry["c"]] += entry["n"]
+        else:
+            channels = [a + b for a, b in zip(channels, doc["channels"])]
+    return {"deviceid": deviceId, "date": start, "end": start + timedelta(hours=1),
+            "nintervals": len(intervals), "counts": sum(channels), "channels": channels,
+            "realtime": sum(doc["realtime"] for doc in intervals),
+            "livetime": sum(doc["livetime"] for doc in intervals), "intervals": intervals}
+
+
+class RangeSpectrumTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = FakeDatabase()
+        self.t0 = datetime(2014, 5, 1)
+
+    def at(self, minutes):
+        return self.t0 + timedelta(minutes=minutes)
+
+    def test_ensure_indexes(self):
+        ensureIndexes(self.db)
+        keys = [("deviceid", 1), ("date", 1)]
+        self.assertEqual(self.db.spectrum.indexes, [(keys, False)])
+        self.assertEqual(self.db.spectrum_bucket.indexes, [(keys, True)])
+
+    def test_spectrum_documents(self):
+        for minutes, device in [(-1, "000000-000000"), (0, "000000-000000"), (30, "000000-000000"),
+                                (60, "000000-000000"), (30, "other")]:
+            doc = interval(self.at(minutes), [1, 0, 2, 0, 0, 0, 0, 3], sparse=False)
+            doc["deviceid"] = device
+            self.db.spectrum.documents.append(doc)
+
+        channels, realtime, livetime = rangeSpectrum(self.db, "000000-000000", self.at(0), self.at(60), NB_CHANNELS)
+        self.assertEqual(channels, [2, 0, 4, 0, 0, 0, 0, 6])
+        self.assertEqual(realtime, 120.0)
+        self.assertEqual(livetime, 118.0)
+
+    def test_buckets(self):
+        # Inside the range: the bucket totals are used
+        self.db.spectrum_bucket.documents.append(bucket(self.at(60), [
+            interval(self.at(60), [0, 1, 0, 0, 0, 0, 0, 0]),
+            interval(self.at(61), [0, 0, 0, 0, 0, 0, 0, 5])]))
+        # Overlapping the range start: only the intervals inside the range,
+        # sparse and dense (legacy) intervals alike
+        self.db.spectrum_bucket.documents.append(bucket(self.at(0), [
+            interval(self.at(29), [7, 0, 0, 0, 0, 0, 0, 0], sparse=False),
+            interval(self.at(30), [0, 0, 1, 0, 0, 0, 0, 0], sparse=False),
+            interval(self.at(31), [0, 0, 0, 2, 0, 0, 0, 1])]))
+        # Outside the range
+        self.db.spectrum_bucket.documents.append(bucket(self.at(120), [
+            interval(self.at(120), [9, 9, 9, 9, 9, 9, 9, 9])]))
+        # Kept as a plain spectrum document (bucket full)
+        doc = interval(self.at(62), [0, 0, 0, 0, 4, 0, 0, 0], sparse=False)
+        doc["deviceid"] = "000000-000000"
+        self.db.spectrum.documents.append(doc)
+
+        channels, realtime, livetime = rangeSpectrum(self.db, "000000-000000", self.at(30), self.at(120), NB_CHANNELS)
+        self.assertEqual(channels, [0, 1, 1, 2, 4, 0, 0, 6])
+        self.assertEqual(realtime, 5 * 60.0)
+        self.assertEqual(livetime, 5 * 59.0)
+
+    def test_empty_range(self):
+        channels, realtime, livetime = rangeSpectrum(self.db, "000000-000000", self.at(0), self.at(60), NB_CHANNELS)
+        self.assertEqual(channels, [0] * NB_CHANNELS)
+        self.assertEqual((realtime, livetime), (0.0, 0.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
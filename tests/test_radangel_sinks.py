@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+#
+# Storage sink tests, run from the repository root with
+# python -m unittest discover tests (the capture runs on Python 2).
+#
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+if sys.version_info[0] > 2:
+    raise unittest.SkipTest("radangel runs on Python 2")
+
+from radangel_sinks import SQLiteSink
+
+
+def makeRecord(date, counts=1, deviceId="000000-000000"):
+    channels = [0] * 4096
+    channels[100] = counts
+    return {"deviceid": deviceId, "date": date, "realtime": 60.0, "livetime": 59.5,
+            "cpm": counts, "counts": counts, "channels": channels}
+
+
+class SQLiteSinkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "radangel.db")
+        self.sink = SQLiteSink(self.filename, batchSize=4, maxDelay=0.2)
+        self.sink.open()
+        self.start = datetime(2014, 5, 1)
+
+    def tearDown(self):
+        self.sink.close()
+        shutil.rmtree(self.directory)
+
+    def storedCount(self):
+        # A separate connection, as a reader of the database would
+        reader = sqlite3.connect(self.filename)
+        try:
+            return reader.execute("SELECT COUNT(*) FROM spectrum").fetchone()[0]
+        finally:
+            reader.close()
+
+    def test_wal_mode(self):
+        mode = self.sink.connection.execute("PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(mode, "wal")
+
+    def test_batching(self):
+        for i in range(3):
+            self.sink.write(makeRecord(self.start + timedelta(minutes=i)))
+        self.assertEqual(self.storedCount(), 0)
+        self.sink.write(makeRecord(self.start + timedelta(minutes=3)))
+        self.assertEqual(self.storedCount(), 4)
+
+    def test_max_delay_on_poll(self):
+        self.sink.write(makeRecord(self.start))
+        self.sink.poll()
+        self.assertEqual(self.storedCount(), 0)
+        time.sleep(0.25)
+        self.sink.poll()
+        self.assertEqual(self.storedCount(), 1)
+
+    def test_records_range(self):
+        for i in range(6):
+            self.sink.write(makeRecord(self.start + timedelta(minutes=i), counts=i))
+        self.sink.write(makeRecord(self.start, deviceId="other"))
+        self.sink.flush()
+        records = list(self.sink.records("000000-000000", self.start + timedelta(minutes=1),
+                                         self.start + timedelta(minutes=3)))
+        self.assertEqual([r["counts"] for r in records], [1, 2, 3])
+        self.assertEqual(records[0]["date"], self.start + timedelta(minutes=1))
+        self.assertEqual(records[2]["channels"], makeRecord(self.start, counts=3)["channels"])
+        self.assertEqual(len(list(self.sink.records("000000-000000"))), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
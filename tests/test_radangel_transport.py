@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+#
+# Capture node to aggregator transport tests (loopback TCP)
+#
+import os
+import sys
+import socket
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+if sys.version_info[0] > 2:
+    raise unittest.SkipTest("radangel runs on Python 2")
+
+from radangel_transport import Aggregator, NetworkSink
+
+
+class MemorySink(object):
+
+    def __init__(self):
+        self.records = []
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def writeMany(self, records):
+        self.records.extend(records)
+
+
+def freeAddress():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return "127.0.0.1:%d" % port
+
+
+class TransportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # The node spills its pending records to the current directory
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+        self.address = freeAddress()
+        self.aggregators = []
+        self.start = datetime(2014, 5, 1, 12, 0, 0, 250000)
+
+    def tearDown(self):
+        for aggregator in self.aggregators:
+            if not aggregator.Terminated:
+                aggregator.stop()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def startAggregator(self):
+        sink = MemorySink()
+        aggregator = Aggregator(self.address, [sink])
+        aggregator.start()
+        self.aggregators.append(aggregator)
+        return aggregator, sink
+
+    def record(self, i):
+        return {"deviceid": "000000-000000", "date": self.start + timedelta(seconds=i),
+                "counts": i, "channels": [i, 0, 1]}
+
+    def test_round_trip(self):
+        aggregator, sink = self.startAggregator()
+        node = NetworkSink(self.address, "000000-000000", batchSize=2, timeout=2.0)
+        node.open()
+        for i in range(5):
+            node.write(self.record(i))
+        # Two acknowledged frames, the last record waits for its batch
+        self.assertEqual(len(sink.records), 4)
+        self.assertEqual(node.pending, [self.record(4)])
+        node.close()
+        aggregator.stop()
+
+        self.assertEqual(sink.records, [self.record(i) for i in range(5)])
+        self.assertFalse(os.path.exists(node.spillFilename))
+
+    def test_duplicates_dropped(self):
+        aggregator, sink = self.startAggregator()
+        node = NetworkSink(self.address, "000000-000000", timeout=2.0)
+        node.write(self.record(0))
+        node.write(self.record(0))
+        node.write(self.record(1))
+        node.close()
+        aggregator.stop()
+
+        self.assertEqual(sink.records, [self.record(0), self.record(1)])
+        self.assertEqual(aggregator.duplicates, 1)
+
+    def test_replay_after_reconnect(self):
+        aggregator, firstSink = self.startAggregator()
+        node = NetworkSink(self.address, "000000-000000", batchSize=2, timeout=0.5, retryDelay=0.0,
+                           maxPending=4, replayBatches=2)
+        node.write(self.record(0))
+        node.write(self.record(1))
+        self.assertEqual(len(firstSink.records), 2)
+
+        # Aggregator down: nothing acknowledged, the records beyond maxPending are spilled
+        aggregator.stop()
+        for i in range(2, 12):
+            node.write(self.record(i))
+        self.assertEqual(len(firstSink.records), 2)
+        self.assertEqual(len(node.pending), 4)
+        self.assertTrue(os.path.exists(node.spillFilename))
+
+        # Aggregator back: pending records first, then the spill file in replayBatches frames
+        aggregator, secondSink = self.startAggregator()
+        node.flush()
+        self.assertEqual(len(node.pending), 0)
+        self.assertEqual(len(secondSink.records), 4 + 2 * 2)
+        node.flush()
+        node.close()
+        aggregator.stop()
+
+        self.assertEqual(sorted(r["counts"] for r in secondSink.records), range(2, 12))
+        self.assertFalse(os.path.exists(node.spillFilename))
+
+
+if __name__ == '__main__':
+    unittest.main()